@@ -3,6 +3,7 @@ import collections
 import tempfile
 import subprocess
 import requests
+import hashlib
 import json
 from pathlib import Path
 
@@ -105,6 +106,20 @@ def installable_url():
     raise RuntimeError("did not find any install-capable repo amongst host repos")
 
 
+def repomd_digest(url):
+    """
+    Return a sha256 of repository metadata (repomd.xml) of a repository
+    at 'url', which changes with any change of the repository content,
+    or None if it cannot be retrieved.
+    """
+    try:
+        reply = requests.get(url.rstrip('/') + '/repodata/repomd.xml', verify=False)
+        reply.raise_for_status()
+    except requests.exceptions.RequestException:
+        return None
+    return hashlib.sha256(reply.content).hexdigest()
+
+
 @contextlib.contextmanager
 def download_rpm(nvr, source=False):
     """
@@ -16,6 +16,9 @@ VMs via Guest.install(), they are created from images via Guest.create().
 
     g.create(blueprint=blueprint)
 
+    # or create multiple guests, building their images in parallel
+    osbuild.Guest.create_many([(g, blueprint), (other_guest, None)])
+
     with g.booted():
         g.ssh( ... )
         g.ssh( ... )
@@ -23,6 +26,7 @@ VMs via Guest.install(), they are created from images via Guest.create().
 Snapshotting is currently not supported/tested with this approach.
 """
 
+import os
 import sys
 import re
 import subprocess
@@ -33,7 +37,12 @@ import json
 import platform
 import shutil
 import time
+import errno
+import socket
+import hashlib
 import collections
+import http.client
+import urllib.parse
 from pathlib import Path
 
 from lib import util, dnf, virt
@@ -44,6 +53,13 @@ from lib import util, dnf, virt
 # The qcow2 image generated by composer-cli is sparse, so actual disk usage is much smaller.
 QCOW2_IMAGE_SIZE_MIB = 100 * 1024
 
+# unix socket of the osbuild-composer (weldr) API, as used by composer-cli
+WELDR_SOCKET = '/run/weldr/api.socket'
+
+# granularity of holes created when downloading (sparse) images
+_SPARSE_BLOCK = 1024 * 1024
+_ZERO_BLOCK = bytes(_SPARSE_BLOCK)
+
 
 class Host:
     @staticmethod
@@ -115,6 +131,250 @@ class ComposerRepos:
             )
 
 
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=60):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(str(self.socket_path))
+
+
+class WeldrClient:
+    """
+    A minimal client of the osbuild-composer (weldr) HTTP API, talking
+    directly to its unix socket, without spawning composer-cli.
+
+    Any unix socket server speaking HTTP can be passed as 'socket_path',
+    ie. a stand-in for osbuild-composer.
+    """
+
+    API = '/api/v1'
+
+    def __init__(self, socket_path=WELDR_SOCKET):
+        self.socket_path = socket_path
+
+    @contextlib.contextmanager
+    def request(self, method, path, body=None, timeout=60):
+        """
+        Send an HTTP request to 'path' (relative to the API root) and yield
+        a http.client.HTTPResponse, which can be read in a streaming fashion.
+
+        'body', if specified, is serialized as JSON.
+        """
+        conn = _UnixHTTPConnection(self.socket_path, timeout=timeout)
+        try:
+            headers = {}
+            if body is not None:
+                body = json.dumps(body)
+                headers['Content-Type'] = 'application/json'
+            conn.request(method, f'{self.API}{path}', body=body, headers=headers)
+            reply = conn.getresponse()
+            if reply.status >= 400:
+                error = reply.read().decode(errors='replace')
+                # weldr API errors are {"status":false,"errors":[{"id":..,"msg":..}]}
+                with contextlib.suppress(ValueError, KeyError, TypeError):
+                    error = ', '.join(x['msg'] for x in json.loads(error)['errors'])
+                raise RuntimeError(f"weldr {method} {path}: {reply.status}: {error}")
+            yield reply
+        finally:
+            conn.close()
+
+    def query(self, method, path, body=None):
+        with self.request(method, path, body) as reply:
+            return json.loads(reply.read())
+
+    @staticmethod
+    def _to_entry(status):
+        return Compose._Entry(
+            status['id'],
+            status['queue_status'],
+            status['blueprint'],
+            status['version'],
+            status['compose_type'],
+        )
+
+    def compose_list(self, *, blueprint=None):
+        """
+        Return a list of Compose._Entry for all composes known to composer,
+        optionally only for a given 'blueprint' name.
+        """
+        query = urllib.parse.urlencode({'blueprint': blueprint} if blueprint else {})
+        path = '/compose/status/*' + (f'?{query}' if query else '')
+        return [self._to_entry(x) for x in self.query('GET', path)['uuids']]
+
+    def compose_status(self, compose_id):
+        """
+        Return a Compose._Entry for one 'compose_id', or None if composer
+        doesn't know about it.
+        """
+        try:
+            uuids = self.query('GET', f'/compose/status/{compose_id}')['uuids']
+        except RuntimeError:
+            return None
+        return self._to_entry(uuids[0]) if uuids else None
+
+    def compose_start(self, blueprint_name, compose_type='qcow2', *, size_mib=None):
+        """
+        Start building 'blueprint_name' into an image of 'compose_type',
+        returning the ID of the new compose.
+        """
+        body = {
+            'blueprint_name': blueprint_name,
+            'compose_type': compose_type,
+            'branch': 'master',
+        }
+        if size_mib:
+            body['size'] = size_mib * 1024 * 1024
+        return self.query('POST', '/compose', body)['build_id']
+
+    def compose_cancel(self, compose_id):
+        self.query('DELETE', f'/compose/cancel/{compose_id}')
+
+    def compose_delete(self, compose_id):
+        self.query('DELETE', f'/compose/delete/{compose_id}')
+
+    def iter_finished(self, compose_ids, *, timeout=7200, min_delay=1, max_delay=30):
+        """
+        Wait for composes of 'compose_ids' to reach one of
+        Compose.FINISHED_STATUSES, yielding a Compose._Entry for each,
+        in the order they finish.
+
+        All still unfinished composes are queried together, with an
+        exponentially increasing delay (from 'min_delay' up to 'max_delay'
+        seconds) between the queries.
+        """
+        end_time = time.monotonic() + timeout
+        delay = min_delay
+        last_statuses = {}
+        pending = list(compose_ids)
+        while pending:
+            if time.monotonic() >= end_time:
+                raise TimeoutError(f"waiting for composes {pending} timed out")
+            uuids = self.query('GET', f'/compose/status/{",".join(pending)}')['uuids']
+            entries = {x.id: x for x in map(self._to_entry, uuids)}
+            for compose_id in pending.copy():
+                entry = entries.get(compose_id)
+                if not entry:
+                    raise FileNotFoundError(f"compose {compose_id} disappeared")
+                if entry.status in Compose.FINISHED_STATUSES:
+                    pending.remove(compose_id)
+                    yield entry
+                elif entry.status != last_statuses.get(compose_id):
+                    util.log(f"compose {compose_id} is {entry.status}")
+                    last_statuses[compose_id] = entry.status
+                    # re-start the backoff on every status change
+                    delay = min_delay
+            if pending:
+                time.sleep(delay)
+                delay = min(delay * 2, max_delay)
+
+    def wait_for_compose(self, compose_id, **kwargs):
+        """
+        Wait for a single compose to finish, return its final Compose._Entry.
+
+        Any 'kwargs' are passed to iter_finished().
+        """
+        return next(self.iter_finished([compose_id], **kwargs))
+
+    def compose_log(self, compose_id, *, size_kb=None, chunk_size=65536):
+        """
+        Yield the build log of 'compose_id' as str chunks, as they are
+        received from composer.
+
+        If 'size_kb' is given, return only the last 'size_kb' KiB of the log.
+        """
+        path = f'/compose/log/{compose_id}'
+        if size_kb is not None:
+            path += f'?size={size_kb}'
+        with self.request('GET', path, timeout=600) as reply:
+            while chunk := reply.read(chunk_size):
+                yield chunk.decode(errors='replace')
+
+    def compose_image(self, compose_id, dest):
+        """
+        Stream the image of a finished 'compose_id' directly to 'dest',
+        skipping over all-zero blocks to keep the file sparse.
+
+        The received data is hashed and compared to a hash of the written
+        file, and to the Content-Length announced by composer.
+        """
+        dest = Path(dest)
+        util.log(f"downloading image of {compose_id} to {dest}")
+        digest = hashlib.sha256()
+        start = time.monotonic()
+        with self.request('GET', f'/compose/image/{compose_id}', timeout=600) as reply:
+            expected_size = reply.getheader('Content-Length')
+            try:
+                with open(dest, 'wb') as f:
+                    size = 0
+                    while chunk := reply.read(_SPARSE_BLOCK):
+                        digest.update(chunk)
+                        if chunk == _ZERO_BLOCK[:len(chunk)]:
+                            f.seek(len(chunk), os.SEEK_CUR)
+                        else:
+                            f.write(chunk)
+                        size += len(chunk)
+                    # extend the file in case it ends with a hole
+                    f.truncate(size)
+                if expected_size is not None and size != int(expected_size):
+                    raise RuntimeError(
+                        f"image of {compose_id} is {size} bytes, expected {expected_size}",
+                    )
+                if _sparse_sha256(dest) != digest.hexdigest():
+                    raise RuntimeError(f"{dest} contents differ from the downloaded image")
+            except BaseException:
+                dest.unlink(missing_ok=True)
+                raise
+        duration = max(time.monotonic() - start, 0.001)
+        mib = size / 1024**2
+        allocated_mib = dest.stat().st_blocks * 512 / 1024**2
+        util.log(
+            f"downloaded {mib:.0f} MiB ({allocated_mib:.0f} MiB allocated) "
+            f"in {duration:.1f}s, {mib / duration:.1f} MiB/s, sha256 {digest.hexdigest()}",
+        )
+
+
+def _sparse_sha256(path):
+    """
+    Return a sha256 of a file contents, reading only its data regions
+    (via SEEK_DATA/SEEK_HOLE) and hashing holes as zeros.
+    """
+    digest = hashlib.sha256()
+
+    def add_zeros(length):
+        while length > 0:
+            digest.update(_ZERO_BLOCK[:length])
+            length -= _SPARSE_BLOCK
+
+    with open(path, 'rb') as f:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        pos = 0
+        while pos < size:
+            try:
+                data = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError as e:
+                # no more data until the end of file
+                if e.errno != errno.ENXIO:
+                    raise
+                data = size
+            add_zeros(data - pos)
+            if data >= size:
+                break
+            hole = os.lseek(fd, data, os.SEEK_HOLE)
+            f.seek(data)
+            remaining = hole - data
+            while remaining > 0:
+                chunk = f.read(min(remaining, _SPARSE_BLOCK))
+                digest.update(chunk)
+                remaining -= len(chunk)
+            pos = hole
+    return digest.hexdigest()
+
+
 class Compose:
     _Entry = collections.namedtuple(
         'ComposeEntry',
@@ -123,55 +383,63 @@ class Compose:
     RUNNING_STATUSES = ['WAITING', 'RUNNING']
     FINISHED_STATUSES = ['FINISHED', 'FAILED']
 
+    weldr = WeldrClient()
+
     @classmethod
-    def _get_status(cls, filter):
-        out = composer_cli_out('compose', 'list', log=False)
-        lines = iter(out.strip('\n').split('\n'))
-        next(lines)  # skip header (first line)
-        for line in lines:
-            entry = cls._Entry(*re.split(r'[ \t]+', line))
-            if filter(entry):
-                return entry
-        return None
+    @contextlib.contextmanager
+    def build_many(cls, blueprint_names):
+        """
+        Start building all 'blueprint_names' at once, letting osbuild-composer
+        workers build them in parallel, and yield an iterator of
+        (blueprint name, compose ID) tuples in the order the composes finish.
+
+        Any existing composes of the blueprints are deleted first, and the
+        new composes are cancelled (if unfinished) and deleted on exit.
+
+            with Compose.build_many(['bp_one', 'bp_two']) as finished:
+                for bp_name, ident in finished:
+                    ...
+        """
+        # delete any existing composes
+        for name in blueprint_names:
+            for entry in cls.weldr.compose_list(blueprint=name):
+                if entry.status in cls.RUNNING_STATUSES:
+                    cls.weldr.compose_cancel(entry.id)
+                cls.weldr.compose_delete(entry.id)
+
+        started = {}
+        try:
+            for name in blueprint_names:
+                ident = cls.weldr.compose_start(name, size_mib=QCOW2_IMAGE_SIZE_MIB)
+                util.log(f"started compose {ident} of {name}")
+                started[ident] = name
+            yield cls._iter_built(started)
+        finally:
+            # clean up
+            for ident in started:
+                entry = cls.weldr.compose_status(ident)
+                if not entry:
+                    continue
+                if entry.status in cls.RUNNING_STATUSES:
+                    cls.weldr.compose_cancel(ident)
+                cls.weldr.compose_delete(ident)
 
     @classmethod
-    def _wait_for_finished(cls, blueprint_name, sleep=1):
-        entry = cls._get_status(lambda x: x.blueprint == blueprint_name)
-        if not entry:
-            raise FileNotFoundError(f"compose for {blueprint_name} not found in list")
-        util.log(f"waiting for compose {entry.id} to be built")
-        new = entry
-        while new.status not in cls.FINISHED_STATUSES:
-            new = cls._get_status(lambda x: x.id == entry.id)
-            if not new:
-                raise FileNotFoundError(f"compose {entry.id} disappeared")
-            time.sleep(sleep)
-        return new
+    def _iter_built(cls, started):
+        util.log(f"waiting for composes {list(started)} to be built")
+        for entry in cls.weldr.iter_finished(started):
+            if entry.status != 'FINISHED':
+                for chunk in cls.weldr.compose_log(entry.id):
+                    sys.stdout.write(chunk)
+                raise RuntimeError(f"failed to build: {entry}")
+            yield (started[entry.id], entry.id)
 
     @classmethod
     @contextlib.contextmanager
     def build(cls, blueprint_name):
-        entry = cls._get_status(lambda x: x.blueprint == blueprint_name)
-        # delete any existing compose
-        if entry:
-            if entry.status in cls.RUNNING_STATUSES:
-                composer_cli('compose', 'cancel', entry.id)
-            composer_cli('compose', 'delete', entry.id)
-        # start and wait
-        composer_cli(
-            'compose', 'start', blueprint_name, 'qcow2',
-            '--size', str(QCOW2_IMAGE_SIZE_MIB),
-        )
-        entry = cls._wait_for_finished(blueprint_name)
-        # check & yield
-        if entry.status != 'FINISHED':
-            composer_cli('compose', 'log', entry.id)
-            raise RuntimeError(f"failed to build: {entry}")
-        try:
-            yield entry.id
-        finally:
-            # clean up
-            composer_cli('compose', 'delete', entry.id)
+        with cls.build_many([blueprint_name]) as finished:
+            _, ident = next(finished)
+            yield ident
 
 
 # this is using a different approach to class Kickstart or class RpmPack
@@ -189,7 +457,15 @@ class Blueprint:
         version = "1.0.0"
     ''')
 
-    def __init__(self, template=TEMPLATE):
+    def __init__(self, template=TEMPLATE, *, name=NAME):
+        """
+        Use a unique 'name' for each blueprint that is to be present
+        in osbuild-composer at the same time, ie. for Compose.build_many().
+        """
+        self.name = name
+        if template:
+            # the name in the template identifies the blueprint in composer
+            template = re.sub(r'^name = .*', f'name = "{name}"', template, count=1, flags=re.M)
         self.assembled = f'{template}\n\n' if template else ''
 
     def add_user(self, name, *, password=None, groups=None, ssh_pubkey=None):
@@ -245,14 +521,14 @@ class Blueprint:
     @contextlib.contextmanager
     def to_composer(self):
         blueprints = composer_cli_out('blueprints', 'list', log=False)
-        if self.NAME in blueprints:
-            composer_cli('blueprints', 'delete', self.NAME)
+        if self.name in blueprints.split('\n'):
+            composer_cli('blueprints', 'delete', self.name)
         with self.to_tmpfile() as f:
             composer_cli('blueprints', 'push', f)
         try:
-            yield self.NAME
+            yield self.name
         finally:
-            composer_cli('blueprints', 'delete', self.NAME)
+            composer_cli('blueprints', 'delete', self.name)
 
 
 class Guest(virt.Guest):
@@ -282,38 +558,30 @@ class Guest(virt.Guest):
         if not blueprint:
             blueprint = Blueprint()
 
-        image_path = Path(f'{virt.GUEST_IMG_DIR}/{self.name}.img')
-
         with blueprint.to_composer() as bp_name:
-            # re-try multiple times to try to avoid a bug:
-            # ERROR: Depsolve Error: Get "http://localhost/.../depsolve/contest_blueprint": EOF
-            for _ in range(5):
-                ret = composer_cli(
-                    'blueprints', 'depsolve', bp_name, check=False, text=True,
-                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                )
-                sys.stdout.write(ret.stdout)
-                if ret.returncode == 0:
-                    break
-                elif re.match(r'ERROR: Depsolve Error: Get "[^"]+": EOF\n', ret.stdout):
-                    continue
-                else:
-                    raise RuntimeError(f"depsolve:\n{ret.stdout}")
-            else:
-                raise RuntimeError("depsolve failed, retries depleted")
-
+            depsolve(bp_name)
             with Compose.build(bp_name) as ident:
-                if image_path.exists():
-                    image_path.unlink()
-                composer_cli('compose', 'image', ident, '--filename', image_path)
-
-                # get image building log, try to limit its size by cutting off
-                # everything before openscap
-                log = composer_cli_out('compose', 'log', ident)
-                idx = log.find('Stage: org.osbuild.oscap')
-                if idx != -1:
-                    log = log[idx:]
-                Path(self.osbuild_log).write_text(log)
+                self.import_compose(ident, **kwargs)
+
+    def import_compose(self, ident, **kwargs):
+        """
+        Download an image of a finished compose 'ident' (ie. as yielded by
+        Compose.build_many()) along with its build log, and import it as
+        a new guest domain into libvirt.
+        """
+        image_path = Path(f'{virt.GUEST_IMG_DIR}/{self.name}.img')
+        if image_path.exists():
+            image_path.unlink()
+        with virt.timed('image-download', self.name):
+            Compose.weldr.compose_image(ident, image_path)
+
+        # get image building log, try to limit its size by cutting off
+        # everything before openscap
+        log = ''.join(Compose.weldr.compose_log(ident))
+        idx = log.find('Stage: org.osbuild.oscap')
+        if idx != -1:
+            log = log[idx:]
+        Path(self.osbuild_log).write_text(log)
 
         # import the created qcow2 image as a VM
         self.import_image(image_path, 'qcow2', **kwargs)
@@ -326,18 +594,30 @@ class Guest(virt.Guest):
         If custom 'rpmpack' is specified (RpmPack instance), it is used instead
         of a self-made instance.
         """
-        # remove any previously installed guest
-        self.wipe()
+        self.create_many([(self, blueprint)], rpmpack=rpmpack, **kwargs)
 
-        if not blueprint:
-            blueprint = Blueprint()
+    @classmethod
+    def create_many(cls, guests, *, rpmpack=None, **kwargs):
+        """
+        Create disk images of multiple guests like create(), but build them
+        all at once, letting osbuild-composer workers build them in parallel.
 
-        # implicitly install openscap-scanner, like virt.Guest.install()
-        blueprint.add_package('openscap-scanner')
+        'guests' is a list of (Guest, Blueprint or None) tuples, the blueprints
+        need unique names (see Blueprint.__init__()). The 'rpmpack' and any
+        extra 'kwargs' are shared by all the guests, so they all need to have
+        the same 'vsock' value.
 
-        # generate an ssh key the same way as virt.Guest
-        self.generate_ssh_keypair()
-        blueprint.add_user('root', password=virt.GUEST_LOGIN_PASS, ssh_pubkey=self.ssh_pubkey)
+            one, two = osbuild.Guest(name='one'), osbuild.Guest(name='two')
+            osbuild.Guest.create_many([(one, None), (two, None)])
+        """
+        guests = [
+            (guest, blueprint or Blueprint(name=f'{Blueprint.NAME}_{guest.name}'))
+            for guest, blueprint in guests
+        ]
+        if len({blueprint.name for _, blueprint in guests}) != len(guests):
+            raise ValueError("blueprints of the guests need unique names")
+        if len({guest.vsock for guest, _ in guests}) > 1:
+            raise ValueError("all guests need to have the same 'vsock' value")
 
         # osbuild doesn't support running Anaconda %post-style custom
         # scripts, the only way to run additional shell code is via
@@ -346,27 +626,98 @@ class Guest(virt.Guest):
         pack.add_host_repos()
         pack.add_sshd_late_start()
         # inherited from virt.Guest
-        pack.requires += self.GUEST_REQUIRES
-        with pack.build_as_repo() as repo:
+        pack.requires += cls.GUEST_REQUIRES
+        if guests[0][0].vsock:
+            pack.add_vsock_agent(virt.GUEST_VSOCK_PORT)
+
+        # overwrite default Red Hat CDN host repos via a custom HTTP server
+        repos = ComposerRepos()
+        repos.add_host_repos()
+
+        cache = virt.ImageCache.from_env()
+        # (guest, blueprint, image cache key) of guests not found in the cache
+        to_build = []
+        for guest, blueprint in guests:
+            # remove any previously installed guest
+            guest.wipe()
+
+            # implicitly install openscap-scanner, like virt.Guest.install()
+            blueprint.add_package('openscap-scanner')
+
+            # re-use an identical image from the image cache, if enabled,
+            # like virt.Guest.install()
+            cache_key = None
+            if cache:
+                cache_key = cache.make_guest_key(
+                    blueprint.assembled,
+                    repos.assemble(),
+                    pack=pack,
+                    repo_urls=[x['baseurl'] for x in repos.repos if 'baseurl' in x],
+                    install_kwargs=kwargs,
+                )
+                disk_path = Path(f'{virt.GUEST_IMG_DIR}/{guest.name}.img')
+                extra_files = {'osbuild.txt': guest.osbuild_log}
+                if guest._load_from_cache(cache, cache_key, disk_path, extra_files=extra_files):
+                    continue
+
+            # generate an ssh key the same way as virt.Guest
+            guest.generate_ssh_keypair()
+            blueprint.add_user('root', password=virt.GUEST_LOGIN_PASS, ssh_pubkey=guest.ssh_pubkey)
             # ensure the custom RPM is added during image building
             blueprint.add_package(util.RpmPack.NAME)
 
+            to_build.append((guest, blueprint, cache_key))
+
+        if not to_build:
+            return
+
+        with contextlib.ExitStack() as stack:
+            repo = stack.enter_context(pack.build_as_repo())
             # osbuild-composer doesn't support file:// repos, so host
             # the custom RPM on a HTTP server
-            with util.BackgroundHTTPServer('127.0.0.1', 0) as srv:
-                srv.add_dir(repo, 'repo')
-                http_host, http_port = srv.start()
-
-                # overwrite default Red Hat CDN host repos via a custom HTTP server
-                repos = ComposerRepos()
-                repos.add_host_repos()
-                repos.repos.append({
-                    'name': 'contest-rpmpack',
-                    'baseurl': f'http://{http_host}:{http_port}/repo',
-                })
-                with repos.to_composer():
-                    # build qcow2 and import it
-                    self.create_basic(blueprint=blueprint, **kwargs)
+            srv = stack.enter_context(util.BackgroundHTTPServer('127.0.0.1', 0))
+            srv.add_dir(repo, 'repo')
+            http_host, http_port = srv.start()
+
+            repos.repos.append({
+                'name': 'contest-rpmpack',
+                'baseurl': f'http://{http_host}:{http_port}/repo',
+            })
+            stack.enter_context(repos.to_composer())
+
+            # blueprint name -> (guest, image cache key)
+            building = {}
+            for guest, blueprint, cache_key in to_build:
+                util.log(f"creating guest {guest.name}")
+                bp_name = stack.enter_context(blueprint.to_composer())
+                depsolve(bp_name)
+                building[bp_name] = (guest, cache_key)
+
+            # build qcow2 images and import them as they finish
+            finished = stack.enter_context(Compose.build_many(list(building)))
+            for bp_name, ident in finished:
+                guest, cache_key = building[bp_name]
+                guest.import_compose(ident, **kwargs)
+                if cache:
+                    cache.store(cache_key, guest, extra_files={'osbuild.txt': guest.osbuild_log})
+
+
+def depsolve(blueprint_name):
+    # re-try multiple times to try to avoid a bug:
+    # ERROR: Depsolve Error: Get "http://localhost/.../depsolve/contest_blueprint": EOF
+    for _ in range(5):
+        ret = composer_cli(
+            'blueprints', 'depsolve', blueprint_name, check=False, text=True,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        )
+        sys.stdout.write(ret.stdout)
+        if ret.returncode == 0:
+            return
+        elif re.match(r'ERROR: Depsolve Error: Get "[^"]+": EOF\n', ret.stdout):
+            continue
+        else:
+            raise RuntimeError(f"depsolve:\n{ret.stdout}")
+    raise RuntimeError("depsolve failed, retries depleted")
 
 
 def composer_cli(*args, log=True, check=True, stderr=subprocess.PIPE, **kwargs):
@@ -379,9 +730,11 @@ def composer_cli_out(*args, **kwargs):
     return out.stdout.rstrip('\n')
 
 
-def translate_oscap_blueprint(lines, datastream):
+def translate_oscap_blueprint(lines, datastream, *, name=Blueprint.NAME):
     """
     Parse (and tweak) a blueprint generated via 'oscap xccdf generate fix'.
+
+    The blueprint is renamed to 'name'.
     """
     bp_text = '\n'.join(lines)
 
@@ -390,7 +743,7 @@ def translate_oscap_blueprint(lines, datastream):
     # like [[packages]] would also match ^name=...
     bp_text = re.sub(
         r'^name = .*',
-        f'name = "{Blueprint.NAME}"',
+        f'name = "{name}"',
         bp_text, count=1, flags=re.M,
     )
 
@@ -426,7 +779,7 @@ def translate_oscap_blueprint(lines, datastream):
                 flags=re.M,
             )
 
-    blueprint = Blueprint(template=bp_text)
+    blueprint = Blueprint(template=bp_text, name=name)
 
     # add openscap hardening, honor global excludes
     blueprint.set_openscap_datastream(datastream)
@@ -3,10 +3,14 @@ Provides utilities and wrappers for creating and manipulating images and
 containers using the 'podman' utility.
 """
 
+import os
 import re
 import time
 import gzip
+import json
+import fcntl
 import shutil
+import hashlib
 import textwrap
 import tempfile
 import requests
@@ -14,9 +18,13 @@ import subprocess
 import urllib3
 from pathlib import Path
 
-from lib import util
+from lib import util, virt
 
 REGISTRY_IMAGE = 'https://github.com/RHSecurityCompliance/contest-data/raw/refs/heads/main/data/docker-registry.tar.gz'
+# uncompressed REGISTRY_IMAGE, kept across tests, with a .json checksum sidecar
+REGISTRY_IMAGE_CACHE = f'{virt.GUEST_IMG_DIR}/contest-registry/docker-registry.tar'
+# label of a persistent Registry container
+PERSISTENT_LABEL = 'contest.persistent'
 
 
 def podman(*args, log=True, check=True, **kwargs):
@@ -78,33 +86,119 @@ class Registry:
         local_image = reg.push('foobar')
         # local_image is ie. '127.0.0.1:12345/foobar'
         ...
+
+    If 'persistent' is True, the registry container is left running after
+    stop(), storing pushed images in a podman volume ('name' + '-data'),
+    and is re-used by any later Registry with the same 'name', so that
+    pushing an image uploads only layers not pushed before.
+    It defaults to CONTEST_PERSISTENT_REGISTRY, and any Registry finding
+    a persistent container of its 'name' re-uses it as well.
     """
-    def __init__(self, name='contest-registry', host_addr='127.0.0.1'):
+    def __init__(self, name='contest-registry', host_addr='127.0.0.1', *, persistent=None):
         self.name = name
         self.addr = host_addr
-        self.registry_image = None
+        if persistent is None:
+            persistent = os.environ.get('CONTEST_PERSISTENT_REGISTRY') == '1'
+        self.persistent = persistent
         self.registry_proc = None
         self.tagged = set()
 
     @staticmethod
-    def _download_image():
+    def _file_sha256(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def _download_image(dest):
         session = requests.Session()
         retries = urllib3.util.Retry(total=10, backoff_factor=0.1)
         session.mount('https://', requests.adapters.HTTPAdapter(max_retries=retries))
         result = session.get(REGISTRY_IMAGE, stream=True)
         result.raise_for_status()
         gz_file = gzip.GzipFile(fileobj=result.raw)
-        with tempfile.NamedTemporaryFile(suffix='.tar', delete=False) as tmpf:
-            shutil.copyfileobj(gz_file, tmpf)
-        return tmpf.name
+        with tempfile.NamedTemporaryFile(dir=dest.parent, suffix='.tar', delete=False) as tmpf:
+            try:
+                shutil.copyfileobj(gz_file, tmpf)
+            except BaseException:
+                Path(tmpf.name).unlink()
+                raise
+        Path(tmpf.name).replace(dest)
+
+    @classmethod
+    def _cached_image(cls):
+        """
+        Return a path to an uncompressed REGISTRY_IMAGE, downloading it only
+        if it isn't cached yet, or if the cached copy fails verification
+        against the checksum recorded when it was downloaded.
+        """
+        image = Path(REGISTRY_IMAGE_CACHE)
+        meta_file = image.with_suffix('.json')
+        image.parent.mkdir(parents=True, exist_ok=True)
+        # serialize concurrent downloads
+        with open(image.with_suffix('.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if image.exists() and meta_file.exists():
+                meta = json.loads(meta_file.read_text())
+                if meta['url'] == REGISTRY_IMAGE and meta['sha256'] == cls._file_sha256(image):
+                    return image
+                util.log(f"cached {image} is outdated or corrupted, re-downloading")
+            util.log(f"downloading {REGISTRY_IMAGE} to {image}")
+            cls._download_image(image)
+            meta = {'url': REGISTRY_IMAGE, 'sha256': cls._file_sha256(image)}
+            meta_file.write_text(json.dumps(meta))
+            return image
+
+    def _container_inspect(self, field):
+        proc = podman('container', 'exists', self.name, check=False, log=False)
+        if proc.returncode != 0:
+            return None
+        proc = podman(
+            'container', 'inspect', '--format', f'{{{{{field}}}}}', self.name,
+            log=False, stdout=subprocess.PIPE,
+        )
+        return proc.stdout.strip()
+
+    def _container_state(self):
+        return self._container_inspect('.State.Status')
+
+    def _start_persistent(self):
+        state = self._container_state()
+        # re-create a stopped container, or one published on a different
+        # address, keeping its volume with all pushed images
+        if state and (state != 'running' or self.get_listen_addr()[0] != self.addr):
+            util.log(f"re-creating container for {self.name}")
+            podman('container', 'rm', '--force', self.name)
+            state = None
+        if state:
+            util.log(f"re-using running container for {self.name}")
+        else:
+            util.log(f"creating persistent container for {self.name}")
+            podman(
+                'container', 'run', '--detach', '--name', self.name,
+                '--label', f'{PERSISTENT_LABEL}=1',
+                '--publish', f'{self.addr}::5000',
+                '--volume', f'{self.name}-data:/var/lib/registry',
+                f'docker-archive:{self._cached_image()}',
+            )
+        host, port = self.get_listen_addr()
+        util.wait_for_tcp(host, port)
 
     def start(self):
+        # a persistent registry of the same name is running, use it
+        # rather than failing on a container name conflict
+        if self._container_inspect(f'index .Config.Labels "{PERSISTENT_LABEL}"') == '1':
+            self.persistent = True
+        if self.persistent:
+            self._start_persistent()
+            return
         util.log(f"starting container for {self.name}")
-        # download the registry image and start it as a container
-        self.registry_image = Path(self._download_image())
+        # start the (cached) registry image as a container
         self.registry_proc = util.subprocess_Popen([
             'podman', 'container', 'run', '--rm', '--name', self.name,
-            '--publish', f'{self.addr}::5000', f'docker-archive:{self.registry_image}',
+            '--publish', f'{self.addr}::5000', f'docker-archive:{self._cached_image()}',
         ])
         try:
             # wait for the registry server to start existing
@@ -129,13 +223,22 @@ class Registry:
     def stop(self):
         for tag in self.tagged:
             podman('image', 'untag', tag)
+        self.tagged = set()
         if self.registry_proc:
             util.log(f"stopping container for {self.name}")
             self.registry_proc.terminate()
             self.registry_proc.wait()
-        if self.registry_image:
-            self.registry_image.unlink()
-            self.registry_image = None
+            self.registry_proc = None
+
+    @classmethod
+    def remove_persistent(cls, name='contest-registry'):
+        """
+        Remove a persistent registry container 'name' along with
+        all images pushed to it.
+        """
+        podman('container', 'rm', '--force', '--ignore', name)
+        if podman('volume', 'exists', f'{name}-data', check=False, log=False).returncode == 0:
+            podman('volume', 'rm', '--force', f'{name}-data')
 
     def get_listen_addr(self):
         """
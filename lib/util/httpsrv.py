@@ -14,6 +14,15 @@ Any HTTP GET requests for '/visible.txt' will receive the contents of
 Any HTTP GET requests for '/somedir/aa/bb' will receive the contents of
 '/on/disk/dir/aa/bb' (or 404).
 
+Remote HTTP(S) locations can be mapped too, with downloaded files being
+cached on disk, making the server a caching mirror:
+
+    srv.add_proxy('https://example.com/repo', '/mirror', '/var/cache/mirror')
+
+Any HTTP GET requests for '/mirror/aa/bb' will then receive the contents of
+'https://example.com/repo/aa/bb', downloaded only on the first request
+(see UNCACHEABLE_FILES and REVALIDATED_DIRS for exceptions).
+
 You can call 'srv.add_*' functions even after calling .start(), however
 be aware that this creates a potential race condition with the request-
 handling code, so make sure nothing queries the server while new entries
@@ -38,22 +47,84 @@ care of stopping it (manually, via try/finally, etc.):
         srv.stop()
 """
 
+import os
+import ssl
+import time
+import contextlib
+import json
 import shutil
+import tempfile
 import subprocess
 import threading
+import urllib.error
+import urllib.parse
+import urllib.request
 from pathlib import Path
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 
 from lib import util
 
 
+# files that change in-place in a repository or an install tree,
+# always downloaded from upstream, never cached
+UNCACHEABLE_FILES = {
+    'repomd.xml', 'repomd.xml.asc', 'repomd.xml.key', '.treeinfo', 'treeinfo', '.discinfo',
+}
+
+# install tree directories with files (kernel, initrd, stage2) that change
+# in-place in nightly or "latest" composes - these are cached, but re-validated
+# with upstream (via ETag or Last-Modified) on every request
+REVALIDATED_DIRS = {'images', 'isolinux', 'EFI'}
+
+# prefix of files being downloaded into a proxy cache_dir
+_PARTIAL_PREFIX = '.partial-'
+
+
+def _unverified_ssl_context():
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def evict_proxy_cache(cache_dir, budget):
+    """
+    Remove least recently used files cached by add_proxy() in 'cache_dir'
+    (or any of its subdirectories), until they take up at most 'budget' bytes.
+
+    Partial downloads are left alone, unless left behind by a crash long ago.
+    """
+    files = []
+    for f in Path(cache_dir).rglob('*'):
+        if f.suffix == '.validators':
+            continue
+        # concurrently replaced or evicted
+        with contextlib.suppress(FileNotFoundError):
+            stat = f.stat()
+            if f.name.startswith(_PARTIAL_PREFIX):
+                if stat.st_mtime < time.time() - 86400:
+                    f.unlink()
+            elif f.is_file():
+                files.append((stat.st_mtime, stat.st_blocks * 512, f))
+    total = sum(size for _, size, _ in files)
+    for _, size, f in sorted(files):
+        if total <= budget:
+            break
+        util.log(f"evicting {f} from proxy cache")
+        f.unlink(missing_ok=True)
+        f.with_name(f'{f.name}.validators').unlink(missing_ok=True)
+        total -= size
+
+
 class _BackgroundHTTPServerHandler(SimpleHTTPRequestHandler):
-    def send_file(self, path):
+    def send_file(self, path, *, head=False):
         try:
             with open(path, 'rb') as f:
                 self.send_response(200)
+                self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
                 self.end_headers()
-                shutil.copyfileobj(f, self.wfile)
+                if not head:
+                    shutil.copyfileobj(f, self.wfile)
         except (FileNotFoundError, NotADirectoryError):
             self.send_response(404)
             self.end_headers()
@@ -61,26 +132,133 @@ class _BackgroundHTTPServerHandler(SimpleHTTPRequestHandler):
             self.send_response(403)
             self.end_headers()
 
-    def do_GET(self):  # noqa: N802
+    def _relay(self, reply, length, tmp=None):
+        """
+        Copy an upstream 'reply' to the client (and to 'tmp' if specified),
+        failing if it is shorter than the announced 'length'.
+        """
+        size = 0
+        while chunk := reply.read(1024 * 1024):
+            if tmp:
+                tmp.write(chunk)
+            self.wfile.write(chunk)
+            size += len(chunk)
+        if length and size != int(length):
+            # the client already got the Content-Length, make sure it notices
+            self.close_connection = True
+            raise ConnectionError(f"got {size} of {length} bytes from upstream")
+
+    def send_cached(self, cache_file, *, head=False):
+        # mark the file as recently used, see evict_proxy_cache()
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(cache_file)
+        self.send_file(cache_file, head=head)
+
+    def send_proxied(self, upstream_url, cache_dir, path, *, head=False):
+        if '..' in path.parts:
+            self.send_response(403)
+            self.end_headers()
+            return
+        cache_file = cache_dir / path
+        validators_file = cache_file.with_name(f'{cache_file.name}.validators')
+        revalidate = bool(REVALIDATED_DIRS.intersection(path.parts[:-1]))
+        headers = {}
+        if cache_file.is_file():
+            if not revalidate:
+                self.send_cached(cache_file, head=head)
+                return
+            if validators_file.is_file():
+                validators = json.loads(validators_file.read_text())
+                if validators.get('etag'):
+                    headers['If-None-Match'] = validators['etag']
+                if validators.get('last_modified'):
+                    headers['If-Modified-Since'] = validators['last_modified']
+        url = f'{upstream_url}/{urllib.parse.quote(str(path))}'
+        request = urllib.request.Request(url, headers=headers, method='HEAD' if head else 'GET')
+        try:
+            reply = urllib.request.urlopen(request, context=_unverified_ssl_context(), timeout=60)
+        except urllib.error.HTTPError as e:
+            # cached file is still up-to-date
+            if e.code == 304:
+                self.send_cached(cache_file, head=head)
+            else:
+                self.send_response(e.code)
+                self.end_headers()
+            return
+        except (urllib.error.URLError, OSError):
+            self.send_response(502)
+            self.end_headers()
+            return
+        with reply:
+            self.send_response(200)
+            length = reply.headers.get('Content-Length')
+            if length:
+                self.send_header('Content-Length', length)
+            self.end_headers()
+            if head:
+                return
+            validators = {
+                'etag': reply.headers.get('ETag'),
+                'last_modified': reply.headers.get('Last-Modified'),
+            }
+            # a file changing in-place cannot be cached without a way
+            # to tell when it changed
+            if path.name in UNCACHEABLE_FILES or (revalidate and not any(validators.values())):
+                cache_file.unlink(missing_ok=True)
+                self._relay(reply, length)
+                return
+            # download to a temporary file, so that concurrent requests for
+            # the same file (or a failed download) don't leave a partial file
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                dir=cache_file.parent, prefix=_PARTIAL_PREFIX, delete=False,
+            ) as tmp:
+                tmp_path = Path(tmp.name)
+                try:
+                    self._relay(reply, length, tmp)
+                except BaseException:
+                    tmp_path.unlink()
+                    raise
+            tmp_path.chmod(0o644)
+            tmp_path.replace(cache_file)
+            if revalidate:
+                validators_file.write_text(json.dumps(validators))
+
+    def _serve(self, *, head=False):
         file_map = self.server.file_mapping
         dir_map = self.server.dir_mapping
-        get_path = Path(self.path).relative_to('/')
+        proxy_map = self.server.proxy_mapping
+        request_path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        get_path = Path(request_path).relative_to('/')
         # try a file path match first
         for url_path, fs_path in file_map.items():
             if get_path == url_path:
-                self.send_file(fs_path)
+                self.send_file(fs_path, head=head)
                 return
         # try a directory prefix
         for url_path, fs_path in dir_map.items():
             # if 'prefix/dir' in GET /prefix/dir/some/path
             if url_path in get_path.parents:
                 path_within_dir = get_path.relative_to(url_path)
-                self.send_file(fs_path / path_within_dir)
+                self.send_file(fs_path / path_within_dir, head=head)
                 return
-        # unknown path requested via GET
+        # try a remote location prefix
+        for url_path, (upstream_url, cache_dir) in proxy_map.items():
+            if url_path in get_path.parents:
+                self.send_proxied(
+                    upstream_url, cache_dir, get_path.relative_to(url_path), head=head,
+                )
+                return
+        # unknown path requested
         self.send_response(404)
         self.end_headers()
 
+    def do_GET(self):  # noqa: N802
+        self._serve()
+
+    def do_HEAD(self):  # noqa: N802
+        self._serve(head=True)
+
     def log_message(self, form, *args):
         addr, port = self.server.server_address
         util.log(f'{addr}:{port}: ' + form % args)
@@ -91,6 +269,7 @@ class BackgroundHTTPServer:
         self.server = None
         self.file_mapping = {}
         self.dir_mapping = {}
+        self.proxy_mapping = {}
         self.requested_address = (host, port)
         self.firewalld_zones = []
 
@@ -130,6 +309,23 @@ class BackgroundHTTPServer:
         url_path = Path(fs_path) if url_path is None else Path(url_path.lstrip('/'))
         self.dir_mapping[url_path] = Path(fs_path)
 
+    def add_proxy(self, upstream_url, url_path, cache_dir):
+        """
+        Map a remote HTTP(S) 'upstream_url' to a virtual location on the HTTP
+        server, downloading (and caching in 'cache_dir') files on request.
+
+        Cached files are served from 'cache_dir' without contacting upstream,
+        except for UNCACHEABLE_FILES, which are always downloaded.
+        The 'cache_dir' is never cleaned up, see evict_proxy_cache().
+
+        For example:
+            # GET /fedora/Packages/a/abc.rpm downloads (and caches)
+            # https://example.com/fedora/Packages/a/abc.rpm
+            .add_proxy('https://example.com/fedora', 'fedora', '/var/cache/fedora')
+        """
+        url_path = Path(url_path.lstrip('/'))
+        self.proxy_mapping[url_path] = (upstream_url.rstrip('/'), Path(cache_dir))
+
     def start(self):
         """
         Start the HTTP server - open a listening socket, start serving requests.
@@ -139,15 +335,19 @@ class BackgroundHTTPServer:
 
         Returns a (host, port) tuple the server is listening on.
         """
-        server = HTTPServer(self.requested_address, _BackgroundHTTPServerHandler)
+        server = ThreadingHTTPServer(self.requested_address, _BackgroundHTTPServerHandler)
+        server.daemon_threads = True
 
         host, port = server.server_address
         util.log(f"starting: {host}:{port}")
 
         util.log(f"using file mapping: {self.file_mapping}")
         util.log(f"using dir mapping: {self.dir_mapping}")
+        if self.proxy_mapping:
+            util.log(f"using proxy mapping: {self.proxy_mapping}")
         server.file_mapping = self.file_mapping
         server.dir_mapping = self.dir_mapping
+        server.proxy_mapping = self.proxy_mapping
 
         # allow the target port on the firewall
         if shutil.which('firewall-cmd'):
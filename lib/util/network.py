@@ -1,5 +1,6 @@
 import time
 import socket
+import asyncio
 
 from lib import util
 
@@ -59,3 +60,33 @@ def wait_for_tcp(host, port, *, timeout=600, to_shutdown=False, compare=None):
                 return
             time.sleep(reset_sleep)
     raise TimeoutError(f"waiting for {host}:{port} to {state} timed out")
+
+
+async def async_wait_for_tcp(host, port, *, timeout=600, compare=None):
+    """
+    An asyncio variant of wait_for_tcp(), without 'to_shutdown'.
+    """
+    util.log(f"waiting for {host}:{port} to start listening for {timeout}s", skip_frames=1)
+    socket_timeout = 5
+    reset_sleep = 1
+    overall_end = time.monotonic() + timeout
+    while time.monotonic() < overall_end:
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), socket_timeout,
+            )
+        except (asyncio.TimeoutError, OSError):
+            await asyncio.sleep(reset_sleep)
+            continue
+        try:
+            if compare is None:
+                return
+            data = await asyncio.wait_for(reader.readexactly(len(compare)), socket_timeout)
+            if data == compare:
+                return
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            writer.close()
+        await asyncio.sleep(reset_sleep)
+    raise TimeoutError(f"waiting for {host}:{port} to start timed out")
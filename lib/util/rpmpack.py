@@ -149,6 +149,54 @@ class RpmPack:
         self.add_script('%post', reload_systemd)
         self.add_script('%postun', reload_systemd)
 
+    def add_vsock_agent(self, port=1024):
+        """
+        Install lib/vsock-agent, socket-activated by systemd on AF_VSOCK 'port'
+        early during boot, allowing the host to run commands in the guest
+        via lib/util/vsock.py, independently of guest networking and sshd.
+
+        Note that the agent runs any command as root without authentication,
+        so add it only to guests which are to be used via vsock.
+        """
+        self.requires.append('python3')
+        self.add_file(util.libdir / 'vsock-agent', '/usr/libexec/contest-vsock-agent')
+        # 4294967295 is VMADDR_CID_ANY
+        socket_contents = util.dedent(f'''
+            [Unit]
+            Description=Contest command channel over AF_VSOCK
+
+            [Socket]
+            ListenStream=vsock:4294967295:{port}
+            Accept=yes
+
+            [Install]
+            WantedBy=sockets.target
+        ''')
+        self.add_file_contents(
+            Path('/usr/lib/systemd/system/contest-vsock.socket'),
+            socket_contents,
+        )
+        service_contents = util.dedent('''
+            [Unit]
+            Description=Contest command channel connection
+
+            [Service]
+            ExecStart=/usr/bin/python3 /usr/libexec/contest-vsock-agent
+            StandardInput=socket
+            StandardError=journal
+            Environment=HOME=/root
+        ''')
+        self.add_file_contents(
+            Path('/usr/lib/systemd/system/contest-vsock@.service'),
+            service_contents,
+        )
+        self.add_script('%post', util.dedent('''
+            systemctl enable contest-vsock.socket
+            systemctl is-system-running >/dev/null || exit 0  # offline install
+            systemctl daemon-reload
+            systemctl start contest-vsock.socket
+        '''))
+
     def create_spec(self):
         install_block = files_block = ''
         created_dirs = set()
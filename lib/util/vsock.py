@@ -0,0 +1,137 @@
+"""
+Host-side client of lib/vsock-agent, running commands inside a guest over
+AF_VSOCK, without any dependence on guest networking or sshd.
+
+When executed as a script, this module behaves like a minimal ssh(1):
+
+    python3 -I vsock.py CID PORT -- command args ...
+
+relaying its stdin/stdout/stderr to/from the command and exiting with
+its exit code (or 255 on connection failure), so that it can be used with
+any subprocess-based wrapper instead of ssh.
+
+Note that this file must be importable without 'lib' in sys.path (for the
+script use case), so it only imports from the python standard library.
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import struct
+import threading
+
+_STDIN, _STDOUT, _STDERR, _EXIT, _COMMAND = range(5)
+
+
+def _recv_exact(sock, length):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise EOFError("vsock connection closed unexpectedly")
+        data += chunk
+    return data
+
+
+def _recv_frame(sock):
+    channel, length = struct.unpack('>BI', _recv_exact(sock, 5))
+    return (channel, _recv_exact(sock, length))
+
+
+def _send_frame(sock, channel, data):
+    sock.sendall(struct.pack('>BI', channel, len(data)) + data)
+
+
+def _forward_stdin(sock, stdin_fd):
+    try:
+        while True:
+            data = os.read(stdin_fd, 65536)
+            _send_frame(sock, _STDIN, data)
+            if not data:
+                break
+    except OSError:
+        pass
+
+
+def vsock_connect(cid, port, timeout=None):
+    sock = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect((cid, port))
+    except OSError:
+        sock.close()
+        raise
+    sock.settimeout(None)
+    return sock
+
+
+def wait_for_vsock(cid, port, *, timeout=600):
+    """
+    Wait for a guest with 'cid' to start accepting connections on vsock 'port'.
+    """
+    end_time = time.monotonic() + timeout
+    while time.monotonic() < end_time:
+        try:
+            vsock_connect(cid, port, timeout=5).close()
+            return
+        except OSError:
+            time.sleep(0.5)
+    raise TimeoutError(f"waiting for vsock {cid}:{port} timed out")
+
+
+async def async_wait_for_vsock(cid, port, *, timeout=600):
+    """
+    An asyncio variant of wait_for_vsock().
+    """
+    loop = asyncio.get_running_loop()
+    end_time = time.monotonic() + timeout
+    while time.monotonic() < end_time:
+        sock = socket.socket(socket.AF_VSOCK, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, (cid, port)), 5)
+            return
+        except (asyncio.TimeoutError, OSError):
+            await asyncio.sleep(0.5)
+        finally:
+            sock.close()
+    raise TimeoutError(f"waiting for vsock {cid}:{port} timed out")
+
+
+def vsock_relay(cid, port, command):
+    """
+    Run a shell 'command' string inside a guest, relaying stdio of the current
+    process to/from it. Return the command's exit code.
+    """
+    try:
+        sock = vsock_connect(cid, port, timeout=30)
+    except OSError as e:
+        print(f"vsock: cannot connect to {cid}:{port}: {e}", file=sys.stderr)
+        return 255
+    with sock:
+        _send_frame(sock, _COMMAND, command.encode())
+        threading.Thread(
+            target=_forward_stdin, args=(sock, sys.stdin.fileno()), daemon=True,
+        ).start()
+        outputs = {_STDOUT: sys.stdout.buffer, _STDERR: sys.stderr.buffer}
+        try:
+            while True:
+                channel, data = _recv_frame(sock)
+                if channel == _EXIT:
+                    return struct.unpack('>i', data)[0]
+                outputs[channel].write(data)
+                outputs[channel].flush()
+        except EOFError as e:
+            print(f"vsock: {e}", file=sys.stderr)
+            return 255
+
+
+if __name__ == '__main__':
+    # like ssh(1), join all command arguments to one shell command
+    args = sys.argv[1:]
+    if len(args) < 4 or args[2] != '--':
+        print("usage: vsock.py CID PORT -- command ...", file=sys.stderr)
+        sys.exit(255)
+    sys.exit(vsock_relay(int(args[0]), int(args[1]), ' '.join(args[3:])))
@@ -12,7 +12,8 @@ The host-related functionality is mainly installing libvirt + deps.
 
 The guest-related functionality consists of:
   1) Installing guests (virt-install from URL)
-  2) Preparing guests for snapshotting (booting up, taking RAM image)
+  2) Preparing guests for snapshotting (booting up, taking RAM image),
+     re-using a RAM image from a previous test if the guest is unchanged
   3) Snapshotting guests (repeatedly restoring, using, throwing away)
 
 There is a Guest() class, which represents a guest with a specific name (used
@@ -22,9 +23,15 @@ be used in two ways, both using a context manager ('g' is an instance):
      - Assumes (1) and (2) were done, creates a snapshot and restores the guest
        from its RAM image, waits for ssh.
      - Stops the guest and deletes the snapshot on __exit__
+     - Inside it, g.checkpoint('name') saves the guest state, to be restored
+       again via g.snapshotted(from_checkpoint='name')
    - g.booted()
      - Assumes (1) was done and just boots and waits for ssh.
 
+An installed guest can also be cloned via g.clone() into several independent
+guests, which can then do (2) and (3) concurrently. For (3), AsyncGuest can
+drive many such guests from one asyncio event loop.
+
 Any host yum.repos.d repositories are given to Anaconda via kickstart 'repo'
 upon guest installation.
 
@@ -78,37 +85,92 @@ Example using plain one-time-use guest:
 """
 
 import os
+import sys
 import re
 import time
+import select
+import shutil
+import shlex
 import subprocess
 import textwrap
 import contextlib
 import tempfile
 import json
 import uuid
+import hashlib
+import ipaddress
+import threading
+import asyncio
+import atexit
+import collections
+import concurrent.futures
+import fcntl
 import xml.etree.ElementTree as ET
 from datetime import datetime, timedelta
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 
 from lib import util, versions, dnf, results
 
+# optional, used for talking to libvirt without spawning virsh(1)
+try:
+    import libvirt
+    import libvirt_qemu
+except ImportError:
+    libvirt = libvirt_qemu = None
+
 GUEST_NAME = 'contest'
 GUEST_LOGIN_PASS = 'contest'
 GUEST_SSH_USER = 'root'
+# see RpmPack.add_vsock_agent()
+GUEST_VSOCK_PORT = 1024
 
 GUEST_IMG_DIR = '/var/lib/libvirt/images'
+GUEST_NVRAM_DIR = '/var/lib/libvirt/qemu/nvram'
+# see class ImageCache
+IMAGE_CACHE_DIR = f'{GUEST_IMG_DIR}/contest-cache'
+# see Guest.install() and CONTEST_INSTALL_MIRROR
+INSTALL_MIRROR_DIR = f'{GUEST_IMG_DIR}/contest-mirror'
+# least recently used files are evicted from INSTALL_MIRROR_DIR beyond this size,
+# see CONTEST_INSTALL_MIRROR_SIZE
+INSTALL_MIRROR_SIZE = 20 * 1024**3
+# minimum free space for snapshot overlays in CONTEST_SNAPSHOT_DIR,
+# falling back to GUEST_IMG_DIR if there is less, see CONTEST_SNAPSHOT_DIR_MIN_FREE
+SNAPSHOT_DIR_MIN_FREE = 4 * 1024**3
 
 NETWORK_NETMASK = '255.255.252.0'
 NETWORK_HOST = '192.168.120.1'
-# 1000 guest addrs, refreshing after a week, should be enough
-NETWORK_RANGE = ['192.168.120.2', '192.168.123.254']
+# 500 dynamic guest addrs, refreshing after a week, should be enough
+NETWORK_RANGE = ['192.168.120.2', '192.168.121.254']
 NETWORK_EXPIRY = 168
+# addresses reserved for specific guest domains (by MAC), see reserve_ipaddr()
+NETWORK_RESERVED_RANGE = ['192.168.122.1', '192.168.123.254']
 
 # installing from HTTP URL leads to Anaconda downloading stage2
 # to RAM, leading to notably higher memory requirements during
 # installation
 INSTALL_TIME_RAM = 4096  # in MBs
 
+# see Host.setup_ksm()
+KSM_SYSFS = '/sys/kernel/mm/ksm'
+KSM_TUNABLES = {
+    # scan 1000 pages / 10ms instead of the default 100 pages / 20ms, so that
+    # freshly restored guests get merged within seconds, not minutes
+    'pages_to_scan': 1000,
+    'sleep_millisecs': 10,
+}
+
+# see Host.check_virtiofs(), locations of virtiofsd used by distributions
+VIRTIOFSD_PATHS = ['/usr/libexec/virtiofsd', '/usr/bin/virtiofsd']
+
+# see reserve_ipaddr()
+RESERVATIONS_LOCK = f'{GUEST_IMG_DIR}/contest-reservations.lock'
+# see acquire_guest_slot()
+SLOTS_LEDGER = f'{GUEST_IMG_DIR}/contest-slots.json'
+# RAM (in MBs) to leave for the host OS when running guests
+HOST_RESERVED_RAM = 2048
+# free space in GUEST_IMG_DIR required to start another guest
+HOST_MIN_FREE_DISK = 10 * 1024**3
+
 # as byte-strings
 INSTALL_FAILURES = [
     br"org\.fedoraproject\.Anaconda\.Addons\.OSCAP\.*: The installation should be aborted",
@@ -128,6 +190,13 @@ INSTALL_FAILURES = [
     br"Could not boot.",
 ]
 
+# on-the-fly compression of Guest.tar_to() / Guest.tar_from() streams
+TAR_COMPRESSORS = {
+    'gzip': 'gzip',
+    'xz': 'xz -T0',
+    'zstd': 'zstd -T0',
+}
+
 PIPE = subprocess.PIPE
 DEVNULL = subprocess.DEVNULL
 
@@ -231,8 +300,80 @@ class Host:
         dest.write_text(script)
         dest.chmod(0o755)
 
+    @staticmethod
+    def ksm_stats():
+        """Return a dict of current KSM counters from KSM_SYSFS."""
+        return {
+            name: int(Path(f'{KSM_SYSFS}/{name}').read_text())
+            for name in ['pages_shared', 'pages_sharing', 'pages_unshared', 'full_scans']
+        }
+
     @classmethod
-    def setup(cls):
+    def setup_ksm(cls):
+        """
+        Enable KSM (Kernel Samepage Merging) and tune it for merging the nearly
+        identical RAM of guests restored from the same snapshot, logging
+        the amount of merged memory at exit.
+
+        The original KSM settings (and ksmtuned) are restored at exit.
+        """
+        if not Path(KSM_SYSFS).exists():
+            util.log("KSM not supported by the host kernel, not enabling it")
+            return
+        original = {
+            name: Path(f'{KSM_SYSFS}/{name}').read_text()
+            for name in [*KSM_TUNABLES, 'run']
+        }
+        ksmtuned = subprocess.run(['systemctl', 'is-active', '--quiet', 'ksmtuned'])
+        # ksmtuned would override our settings
+        if ksmtuned.returncode == 0:
+            subprocess.run(['systemctl', 'stop', 'ksmtuned'], stderr=DEVNULL)
+        for name, value in KSM_TUNABLES.items():
+            Path(f'{KSM_SYSFS}/{name}').write_text(f'{value}\n')
+        Path(f'{KSM_SYSFS}/run').write_text('1\n')
+
+        def log_stats_and_restore():
+            stats = cls.ksm_stats()
+            saved = stats['pages_sharing'] * os.sysconf('SC_PAGE_SIZE') // 1024**2
+            util.log(f"KSM: {saved} MiB of guest RAM merged, {stats}")
+            for name, value in original.items():
+                Path(f'{KSM_SYSFS}/{name}').write_text(value)
+            if ksmtuned.returncode == 0:
+                subprocess.run(['systemctl', 'start', 'ksmtuned'], stderr=DEVNULL)
+
+        atexit.register(log_stats_and_restore)
+
+    @staticmethod
+    def check_virtiofs():
+        """
+        Raise RuntimeError if the host cannot share directories with guests
+        read-only via virtiofs, as used by Guest.booted(shared_dirs=...).
+        """
+        virtiofsd = next((x for x in VIRTIOFSD_PATHS if Path(x).exists()), None)
+        if not virtiofsd:
+            raise RuntimeError("virtiofsd not found, install the 'virtiofsd' package")
+        ret = subprocess.run(
+            [virtiofsd, '--help'], stdout=PIPE, stderr=subprocess.STDOUT, text=True,
+        )
+        if '--readonly' not in ret.stdout:
+            raise RuntimeError(f"{virtiofsd} is too old, it doesn't support --readonly")
+        # libvirt passes <readonly/> to virtiofsd since 11.0.0
+        ret = virsh('version', '--daemon', stdout=PIPE, text=True, check=True)
+        match = re.search(r'Running against daemon: (\d+)\.', ret.stdout)
+        if not match or int(match.group(1)) < 11:
+            raise RuntimeError("libvirt 11.0.0 or newer is needed for read-only virtiofs")
+
+    @classmethod
+    def setup(cls, *, ksm=None, virtiofs=False):
+        """
+        Prepare the host for running guests.
+
+        If 'ksm' is True (default: CONTEST_KSM=1 being set), also enable
+        KSM, see setup_ksm().
+
+        If 'virtiofs' is True, fail early if directories cannot be shared
+        with guests, see check_virtiofs().
+        """
         if not cls.check_virt_capability():
             raise RuntimeError("host has no HVM virtualization support")
 
@@ -242,9 +383,17 @@ class Host:
                 ['systemctl', 'start', 'libvirtd'], check=True, stderr=subprocess.PIPE,
             )
 
+        if virtiofs:
+            cls.check_virtiofs()
+
         cls.setup_network()
         cls.create_sshvm('/root/contest-sshvm')
 
+        if ksm is None:
+            ksm = os.environ.get('CONTEST_KSM') == '1'
+        if ksm:
+            cls.setup_ksm()
+
 
 #
 # Anaconda Kickstart related customizations
@@ -345,6 +494,172 @@ class Kickstart:
         self.add_post(script)
 
 
+#
+# cache of installed guest disk images
+#
+
+class ImageCache:
+    """
+    A cache of installed guest disk images, keyed by a hash of everything
+    that went into creating them (see make_key()), so that an identical guest
+    can be re-created by copying a cached image instead of installing it.
+
+    Each entry holds the disk image, the ssh keypair authorized inside it,
+    and optionally the libvirt domain XML (+ UEFI NVRAM) of the guest.
+
+    Images are copied via reflinks if the filesystem supports them (sparse
+    copies otherwise), and least recently used entries are removed whenever
+    the cache grows over 'budget' (in GiB).
+    """
+
+    def __init__(self, budget, cache_dir=IMAGE_CACHE_DIR):
+        self.budget = budget * 1024**3
+        self.cache_dir = Path(cache_dir)
+
+    @classmethod
+    def from_env(cls):
+        """
+        Return an instance using CONTEST_IMAGE_CACHE (budget in GiB),
+        or None if the cache is disabled.
+        """
+        budget = os.environ.get('CONTEST_IMAGE_CACHE')
+        if not budget or float(budget) <= 0:
+            return None
+        return cls(float(budget))
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Return a hash of 'parts', which can be strings, bytes, None,
+        or Paths of files/directories, hashed by their contents.
+        """
+        digest = hashlib.sha256()
+
+        def add(data):
+            digest.update(len(data).to_bytes(8, 'big'))
+            digest.update(data)
+
+        for part in parts:
+            if isinstance(part, Path):
+                files = sorted(part.rglob('*')) if part.is_dir() else [part]
+                for file in files:
+                    if file.is_file():
+                        add(str(file.relative_to(part.parent)).encode())
+                        add(file.read_bytes())
+            elif isinstance(part, bytes):
+                add(part)
+            else:
+                add(repr(part).encode())
+        return digest.hexdigest()
+
+    @classmethod
+    def make_guest_key(cls, *parts, pack, repo_urls, install_kwargs):
+        """
+        Return a key for a guest created from 'parts' (kickstart, blueprint,
+        etc.), a custom RpmPack 'pack', repositories at 'repo_urls' and
+        a dict of 'install_kwargs'.
+
+        Call this before adding random (ssh key, HTTP port) bits to 'parts'.
+        Repository metadata is hashed too, so that an image doesn't outlive
+        the repository content it was created from.
+        """
+        return cls.make_key(
+            *parts,
+            pack.create_spec(),
+            *(f.source for f in pack.files if isinstance(f, pack.FilePath)),
+            *repo_urls,
+            *(dnf.repomd_digest(url) for url in repo_urls),
+            sorted(install_kwargs.items()),
+        )
+
+    @contextlib.contextmanager
+    def _locked(self):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.cache_dir / '.lock', 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _entry_files(self, key):
+        return sorted(self.cache_dir.glob(f'{key}.*')) + sorted(self.cache_dir.glob(f'{key}_*'))
+
+    def _evict(self):
+        entries = sorted(self.cache_dir.glob('*.json'), key=lambda x: x.stat().st_mtime)
+        sizes = {
+            meta.stem: sum(f.stat().st_blocks * 512 for f in self._entry_files(meta.stem))
+            for meta in entries
+        }
+        total = sum(sizes.values())
+        # never evict the most recently used entry
+        for meta in entries[:-1]:
+            if total <= self.budget:
+                break
+            util.log(f"evicting {meta.stem} from image cache")
+            for f in self._entry_files(meta.stem):
+                f.unlink()
+            total -= sizes[meta.stem]
+
+    def store(self, key, guest, *, with_domain=True, extra_files=None):
+        """
+        Store the disk image and ssh keys of an installed (shut off) 'guest'
+        under 'key', along with its domain definition if 'with_domain'.
+
+        Any 'extra_files' (a dict of name: path) are stored too, see load().
+        """
+        util.log(f"storing {guest.disk_path} in image cache as {key}")
+        with self._locked():
+            prefix = self.cache_dir / key
+            _copy_image(guest.disk_path, f'{prefix}.{guest.disk_format}')
+            for suffix in ['', '.pub']:
+                shutil.copy(f'{guest.ssh_keyfile_path}{suffix}', f'{prefix}.sshkey{suffix}')
+            for name, path in (extra_files or {}).items():
+                shutil.copy(path, f'{prefix}.extra.{name}')
+            meta = {'disk_format': guest.disk_format}
+            if with_domain:
+                domain = ET.fromstring(domain_xml(guest.name, inactive=True))
+                nvram = domain.find('os/nvram')
+                if nvram is not None and nvram.text:
+                    shutil.copy(nvram.text, f'{prefix}_VARS.fd')
+                    nvram.text = f'{prefix}_VARS.fd'
+                Path(f'{prefix}.xml').write_bytes(ET.tostring(domain))
+                meta['domain'] = True
+            Path(f'{prefix}.json').write_text(json.dumps(meta))
+            self._evict()
+
+    def load(self, key, guest, disk_path, *, extra_files=None):
+        """
+        Copy a cached disk image stored under 'key' to 'disk_path' and its
+        ssh keys to 'guest', defining a domain for the guest if the entry has
+        a domain definition.
+
+        Any 'extra_files' (a dict of name: path), stored previously
+        by store(), are copied to their paths.
+
+        Return the disk image format, or None if there is no such entry.
+        """
+        with self._locked():
+            prefix = self.cache_dir / key
+            meta_file = Path(f'{prefix}.json')
+            if not meta_file.exists():
+                return None
+            meta = json.loads(meta_file.read_text())
+            util.log(f"using image cache entry {key} for {guest.name}")
+            disk_format = meta['disk_format']
+            _copy_image(f'{prefix}.{disk_format}', disk_path)
+            for suffix in ['', '.pub']:
+                shutil.copy(f'{prefix}.sshkey{suffix}', f'{guest.ssh_keyfile_path}{suffix}')
+            for name, path in (extra_files or {}).items():
+                shutil.copy(f'{prefix}.extra.{name}', path)
+            guest.ssh_pubkey = Path(f'{guest.ssh_keyfile_path}.pub').read_text().rstrip('\n')
+            if meta.get('domain'):
+                xml = Path(f'{prefix}.xml').read_text()
+                define_domain(clone_domain_xml(
+                    xml, guest.name, disk_path, guest_mac(guest.name), disk_format,
+                ))
+            # mark as recently used
+            meta_file.touch()
+            return disk_format
+
+
 #
 # all user-visible guest operations, from installation to ssh
 #
@@ -358,30 +673,49 @@ class Guest:
     when it finds an already installed guest using the same tag.
     Tag-less guests can be used only for snapshotting within the same test
     and should not be shared across tests.
+
+    Set 'vsock' to True to run ssh()/ssh_stream()/copy_to()/copy_from()
+    over AF_VSOCK (see lib/util/vsock.py) instead of ssh, which works even
+    without guest networking, as soon as the guest reaches sockets.target.
+    This requires the guest to be installed via install() with 'vsock' set,
+    as only such guests get a vsock device and the (unauthenticated) guest
+    agent - other guests are left without them, to not alter the system
+    under test.
     """
 
     GUEST_REQUIRES = [
         'qemu-guest-agent',
     ]
 
-    def __init__(self, tag=None, *, name=GUEST_NAME):
+    def __init__(self, tag=None, *, name=GUEST_NAME, vsock=False):
         self.tag = tag or str(uuid.uuid4())
         self.name = name
         self.ipaddr = None
+        self.vsock = vsock
+        self.vsock_cid = None
         self.ssh_keyfile_path = Path(f'{GUEST_IMG_DIR}/{name}.sshkey')
         self.ssh_pubkey = None
+        # socket of a persistent ssh connection, re-used by ssh/scp/rsync
+        self.ssh_control_path = Path(f'{GUEST_IMG_DIR}/{name}.sshctl')
         self.disk_path = None
         self.disk_format = None
         self.state_file_path = Path(f'{GUEST_IMG_DIR}/{name}.state')
+        # identity of the disk/domain the state file was saved from,
+        # so that the state file can be re-used across tests
+        self.state_meta_path = Path(f'{GUEST_IMG_DIR}/{name}.state.json')
         self.snapshot_path = Path(f'{GUEST_IMG_DIR}/{name}-snap.qcow2')
         # if it exists, guest was successfully installed
         self.install_ready_path = Path(f'{GUEST_IMG_DIR}/{name}.install_ready')
         # if True, all snapshot preparation processes were successful
         self.snapshot_ready = False
+        # unique ID of the saved state file, see checkpoint()
+        self.state_id = None
+        # (key, path, future) of an overlay pre-created for the next restore
+        self._next_overlay = None
 
     def install_basic(
         self, location=None, kickstart=None, secure_boot=False, virt_install_args=None,
-        kernel_args=None, final_mem=None, disk_format='qcow2',
+        kernel_args=None, final_mem=None, disk_format='qcow2', vcpus=1,
     ):
         """
         Install a new guest, to a shut down state.
@@ -402,6 +736,8 @@ class Guest:
 
         'disk_format' specifies the VM disk image format (default: 'qcow2').
         Use 'raw' for pre-allocated disks or 'qcow2' for thin-provisioned disks.
+
+        'vcpus' is the number of virtual CPUs of the guest.
         """
         util.log(f"installing guest {self.name}")
 
@@ -426,16 +762,20 @@ class Guest:
         qemu_img_cmd += [disk_path, '100G']
         util.subprocess_run(qemu_img_cmd, check=True, stderr=subprocess.PIPE)
 
+        # let Anaconda already use the address the installed guest will have
+        self.ipaddr = reserve_ipaddr(self.name, guest_mac(self.name))
+
         with kickstart.to_tmpfile() as ksfile:
             virt_install = [
                 'pseudotty', 'virt-install',
                 # installing from HTTP URL leads to Anaconda downloading stage2
                 # to RAM, leading to notably higher memory requirements during
                 # installation
-                '--name', self.name, '--vcpus', '1', '--memory', str(INSTALL_TIME_RAM),
+                '--name', self.name, '--vcpus', str(vcpus), '--memory', str(INSTALL_TIME_RAM),
                 # Use pre-created disk
                 '--disk', f'path={disk_path},format={disk_format},io=native,cache=none',
-                '--network', 'network=default', '--location', location,
+                '--network', f'network=default,mac={guest_mac(self.name)}',
+                '--location', location,
                 '--graphics', 'none', '--console', 'pty', '--rng', '/dev/urandom',
                 # this has nothing to do with rhel8, it just tells v-i to use virtio
                 '--initrd-inject', ksfile, '--os-variant', 'rhel8-unknown',
@@ -450,14 +790,22 @@ class Guest:
             ]
             if secure_boot:
                 virt_install += ['--boot', 'firmware=efi,loader_secure=no']
+            if self.vsock:
+                virt_install += ['--vsock', 'cid.auto=yes']
 
-            executable = util.libdir / 'pseudotty'
-            proc = util.subprocess_Popen(virt_install, stdout=PIPE, executable=executable)
+            # reserve host resources before the installation starts the guest
+            acquire_guest_slot(self.name, INSTALL_TIME_RAM, vcpus)
+            try:
+                executable = util.libdir / 'pseudotty'
+                proc = util.subprocess_Popen(virt_install, stdout=PIPE, executable=executable)
+            except Exception:
+                release_guest_slot(self.name)
+                raise
             fail_exprs = [re.compile(x) for x in INSTALL_FAILURES]
 
             log_path = results.register_log('virt-install.log')
             try:
-                with open(log_path, 'wb') as virt_log:
+                with open(log_path, 'wb') as virt_log, timed('virt-install', self.name):
                     for line in proc.stdout:
                         results.atex_upload_log_data('virt-install.log', line)
                         virt_log.write(line)
@@ -475,6 +823,8 @@ class Guest:
                 self.undefine(incl_storage=True)
                 disk_path.unlink(missing_ok=True)
                 raise e from None
+            finally:
+                release_guest_slot(self.name)
 
         # installed system doesn't need as much RAM, alleviate swap pressure
         if final_mem:
@@ -495,6 +845,12 @@ class Guest:
 
         If custom 'rpmpack' is specified (RpmPack instance), it is used instead
         of a self-made instance.
+
+        If CONTEST_INSTALL_MIRROR=1 is set, the install tree and host repos
+        are downloaded through a local caching mirror (in INSTALL_MIRROR_DIR),
+        so that repeated installs don't re-download the same files.
+        Least recently used files are evicted from the mirror once it grows
+        over CONTEST_INSTALL_MIRROR_SIZE (in GiB, default INSTALL_MIRROR_SIZE).
         """
         # remove any previously installed guest
         self.wipe()
@@ -504,8 +860,6 @@ class Guest:
 
         kickstart.packages.append('openscap-scanner')
         kickstart.add_host_repos()
-        self.generate_ssh_keypair()
-        kickstart.add_authorized_key(self.ssh_pubkey)
 
         # create a custom RPM to run guest setup scripts via RPM scriptlets
         # and install it during Anaconda installation
@@ -513,12 +867,52 @@ class Guest:
         pack.add_host_repos()
         pack.requires += self.GUEST_REQUIRES
         pack.add_sshd_late_start()
+        if self.vsock:
+            pack.add_vsock_agent(GUEST_VSOCK_PORT)
+
+        # re-use an identical installation from the image cache, if enabled
+        cache = ImageCache.from_env()
+        if cache:
+            location = kwargs.get('location') or dnf.installable_url()
+            cache_key = cache.make_guest_key(
+                kickstart.assemble(),
+                pack=pack,
+                repo_urls=[location, *(url for _, url in dnf.repo_urls())],
+                install_kwargs=kwargs,
+            )
+            disk_extension = 'qcow2' if kwargs.get('disk_format', 'qcow2') == 'qcow2' else 'img'
+            disk_path = Path(f'{GUEST_IMG_DIR}/{self.name}.{disk_extension}')
+            if self._load_from_cache(cache, cache_key, disk_path):
+                self.install_ready_path.write_text(self.tag)
+                return
+
+        self.generate_ssh_keypair()
+        kickstart.add_authorized_key(self.ssh_pubkey)
+
         with pack.build_as_repo() as repo:
             # host the custom RPM on a HTTP server, as Anaconda needs a YUM repo
             # to pull packages from
             with util.BackgroundHTTPServer(NETWORK_HOST, 0) as srv:
                 srv.add_dir(repo, 'repo')
+                # upstream URL -> mirror path on the HTTP server
+                mirrors = {}
+                if os.environ.get('CONTEST_INSTALL_MIRROR') == '1':
+                    if not kwargs.get('location'):
+                        kwargs['location'] = dnf.installable_url()
+                    for url in [kwargs['location'], *(url for _, url in dnf.repo_urls())]:
+                        url_hash = hashlib.sha256(url.encode()).hexdigest()[:16]
+                        mirrors[url] = f'mirror/{url_hash}'
+                        srv.add_proxy(url, mirrors[url], f'{INSTALL_MIRROR_DIR}/{url_hash}')
                 http_host, http_port = srv.start()
+                # point Anaconda to the mirror instead of the upstream URLs
+                for url, mirror_path in mirrors.items():
+                    mirror_url = f'http://{http_host}:{http_port}/{mirror_path}'
+                    if kwargs['location'] == url:
+                        kwargs['location'] = mirror_url
+                    kickstart.appends = [
+                        x.removesuffix(url) + mirror_url if x.endswith(f' --baseurl={url}') else x
+                        for x in kickstart.appends
+                    ]
                 # now that we know the address/port of the HTTP server, add it to
                 # the kickstart as well
                 kickstart.add_install_only_repo(
@@ -529,9 +923,30 @@ class Guest:
                 # install the OS using our kickstart
                 self.install_basic(kickstart=kickstart, **kwargs)
 
+        if mirrors:
+            size = os.environ.get('CONTEST_INSTALL_MIRROR_SIZE')
+            size = float(size) * 1024**3 if size else INSTALL_MIRROR_SIZE
+            util.evict_proxy_cache(INSTALL_MIRROR_DIR, size)
+
+        if cache:
+            cache.store(cache_key, self)
+
+    def _load_from_cache(self, cache, key, disk_path, *, extra_files=None):
+        """
+        Re-create the guest from 'key' of an ImageCache 'cache', with its disk
+        at 'disk_path', returning True, or False if 'key' is not cached.
+        """
+        disk_format = cache.load(key, self, disk_path, extra_files=extra_files)
+        if not disk_format:
+            return False
+        self.ipaddr = reserve_ipaddr(self.name, guest_mac(self.name))
+        self.disk_path = disk_path
+        self.disk_format = disk_format
+        return True
+
     def import_image(
         self, disk_path, disk_format='qcow2', *, secure_boot=False, virt_install_args=None,
-        final_mem=None,
+        final_mem=None, vcpus=1,
     ):
         """
         Import an existing disk image, creating a new guest domain from it.
@@ -546,11 +961,13 @@ class Guest:
 
         util.log(f"importing {disk_path} as {disk_format}")
 
+        self.ipaddr = reserve_ipaddr(self.name, guest_mac(self.name))
+
         virt_install = [
             'pseudotty', 'virt-install',
-            '--name', self.name, '--vcpus', '1', '--memory', str(INSTALL_TIME_RAM),
+            '--name', self.name, '--vcpus', str(vcpus), '--memory', str(INSTALL_TIME_RAM),
             '--disk', f'path={disk_path},format={disk_format},io=native,cache=none',
-            '--network', 'network=default',
+            '--network', f'network=default,mac={guest_mac(self.name)}',
             '--graphics', 'none', '--console', 'pty', '--rng', '/dev/urandom',
             '--noreboot', '--import',
             # this has nothing to do with rhel8, it just tells v-i to use virtio
@@ -562,6 +979,8 @@ class Guest:
         ]
         if secure_boot:
             virt_install += ['--boot', 'firmware=efi,loader_secure=yes']
+        if self.vsock:
+            virt_install += ['--vsock', 'cid.auto=yes']
 
         executable = util.libdir / 'pseudotty'
         util.subprocess_run(
@@ -577,31 +996,114 @@ class Guest:
 
     def start(self):
         if guest_domstate(self.name) == 'shut off':
+            # make sure the address is known before the guest boots
+            self.ipaddr = reserve_ipaddr(self.name, domain_mac(self.name))
+            acquire_guest_slot(self.name, *domain_resources(self.name))
             virsh('start', self.name, check=True)
 
     def destroy(self):
+        self._ssh_master_stop()
         state = guest_domstate(self.name)
         if state and state != 'shut off':
-            virsh('destroy', self.name, check=True)
+            destroy_domain(self.name)
+        release_guest_slot(self.name)
 
     def shutdown(self):
-        if guest_domstate(self.name) == 'running':
-            virsh('shutdown', self.name, check=True)
-        wait_for_domstate(self.name, 'shut off')
+        self._ssh_master_stop()
+        with timed('shutdown', self.name):
+            if guest_domstate(self.name) == 'running':
+                virsh('shutdown', self.name, check=True)
+            wait_for_domstate(self.name, 'shut off')
+        release_guest_slot(self.name)
 
     # we cannot shutdown/start a snapshotted guest as that would start it from
     # the persistent non-snapshotted disk - we must somehow reboot the guest OS
     # without exiting the QEMU process - hard 'reset' or ssh/qemu-ga reboot
-    def soft_reboot(self):
-        """Reboot by issuing 'reboot' via ssh."""
-        util.log("rebooting using qemu-guest-agent")
-        self.guest_agent_cmd('guest-shutdown', {'mode': 'reboot'}, blind=True)
-        wait_for_ssh(self.ipaddr, to_shutdown=True)
-        self.ipaddr = wait_for_ifaddr(self.name)
-        wait_for_ssh(self.ipaddr)
+    def soft_reboot(self, *, kexec=None):
+        """
+        Reboot the guest OS via qemu-guest-agent.
+
+        If 'kexec' is True, boot the default kernel (with its current kernel
+        command line) directly via kexec, skipping firmware and bootloader.
+        Defaults to CONTEST_KEXEC_REBOOT=1 being set.
+        """
+        if kexec is None:
+            kexec = os.environ.get('CONTEST_KEXEC_REBOOT') == '1'
+        start_time = time.monotonic()
+        with timed('soft-reboot', self.name, kexec=kexec):
+            if kexec and self._kexec_load():
+                util.log("rebooting using kexec")
+                self._ssh_master_stop()
+                self.ssh('systemctl', '--no-block', 'kexec')
+            else:
+                util.log("rebooting using qemu-guest-agent")
+                self._ssh_master_stop()
+                self.guest_agent_cmd('guest-shutdown', {'mode': 'reboot'}, blind=True)
+            wait_for_ssh(self.ipaddr, to_shutdown=True)
+            self.ipaddr = self._wait_for_ipaddr()
+            self._wait_for_ssh()
+        util.log(f"reboot took {time.monotonic() - start_time:.1f}sec")
+
+    def _kexec_load(self):
+        """
+        Load the default boot entry kernel for kexec, as a bootloader would.
+        Return True on success.
+        """
+        proc = self.ssh(
+            'grubby', '--info=DEFAULT', stdout=subprocess.PIPE, universal_newlines=True,
+        )
+        if proc.returncode != 0:
+            util.log("grubby failed, cannot use kexec")
+            return False
+        # lines like: args="ro crashkernel=auto fips=1"
+        info = {}
+        for line in proc.stdout.splitlines():
+            key, _, value = line.partition('=')
+            info[key] = value.strip('"')
+        # ie. UKI entries have no separate initrd
+        if not info.get('kernel') or not info.get('initrd') or 'args' not in info:
+            util.log("default boot entry has no kernel/initrd/args, cannot use kexec")
+            return False
+        # BLS entries may refer to grubenv variables, ie. $tuned_params,
+        # expand them like the bootloader would (unset ones to nothing)
+        proc = self.ssh(
+            'grub2-editenv', '-', 'list', stdout=subprocess.PIPE, universal_newlines=True,
+        )
+        grubenv = {}
+        if proc.returncode == 0:
+            for line in proc.stdout.splitlines():
+                key, _, value = line.partition('=')
+                grubenv[key] = value
+
+        def expand(value):
+            return re.sub(
+                r'\$(?:\{(\w+)\}|(\w+))',
+                lambda m: grubenv.get(m.group(1) or m.group(2), ''),
+                value,
+            )
+
+        cmdline = expand(info['args'])
+        if 'root' in info:
+            cmdline = f'root={info["root"]} {cmdline}'
+        cmdline = ' '.join(cmdline.split())
+        # initrd may list extra initrds (ie. $tuned_initrd), use the first one
+        initrds = expand(info['initrd']).split()
+        if not initrds:
+            util.log("default boot entry has no initrd, cannot use kexec")
+            return False
+        initrd = initrds[0]
+        proc = self.ssh(
+            'kexec', '-s', '-l', info['kernel'], f'--initrd={initrd}',
+            shlex.quote(f'--append={cmdline}'),
+        )
+        if proc.returncode != 0:
+            util.log("kexec failed to load the kernel, falling back to full reboot")
+            return False
+        return True
 
     def reset(self):
         util.log("rebooting using 'virsh reset'")
+        self._ssh_master_stop()
         virsh('reset', self.name, check=True)
 
     def undefine(self, incl_storage=False):
@@ -611,6 +1113,8 @@ class Guest:
                 'undefine', self.name, '--nvram', '--snapshots-metadata',
                 '--checkpoints-metadata', *storage, check=True,
             )
+        release_ipaddr(self.name)
+        self.ipaddr = None
 
     def is_installed(self):
         if not self.install_ready_path.exists():
@@ -618,17 +1122,173 @@ class Guest:
         tag = self.install_ready_path.read_text()
         return tag == self.tag
 
+    def clone(self, name):
+        """
+        Create a new guest called 'name', sharing the installed disk of this
+        guest as a read-only backing image, and return it as a Guest instance.
+
+        The clone gets its own domain (name, UUID, MAC and thus IP address),
+        its own qcow2 disk overlay, RAM image and snapshot overlay, so several
+        clones can be prepared for snapshotting and snapshotted concurrently,
+        ie. from multiple threads:
+
+            clones = [g.clone(f'{g.name}-{i}') for i in range(4)]
+            for c in clones:
+                c.prepare_for_snapshot()
+                atexit.register(c.cleanup_snapshot)
+            ...
+            with clones[0].snapshotted():
+                ...
+
+        This guest must be installed and shut off, and must not be booted
+        or prepared for snapshotting while any clones exist, as that would
+        modify the backing disk underneath them - it serves as a template.
+        Any previous guest called 'name' is wiped first.
+
+        (One RAM image cannot be shared across clones - libvirt refuses to
+        restore it under a different domain UUID, and the guest's MAC address
+        is saved inside it.)
+        """
+        if not self.is_installed():
+            raise RuntimeError(f"guest {self.name} not installed or installed with different tag")
+        if guest_domstate(self.name) != 'shut off':
+            raise RuntimeError(f"guest {self.name} must be shut off to be cloned")
+
+        base_disk, base_format = get_domain_base_image_disk(self.name)
+
+        clone = self.__class__(self.tag, name=name, vsock=self.vsock)
+        clone.wipe()
+
+        util.log(f"cloning {self.name} to {name}")
+        disk_path = Path(f'{GUEST_IMG_DIR}/{name}.qcow2')
+        cmd = [
+            'qemu-img', 'create', '-q', '-f', 'qcow2',
+            '-b', base_disk, '-F', base_format, disk_path,
+        ]
+        util.subprocess_run(cmd, check=True, stderr=subprocess.PIPE)
+
+        xml = domain_xml(self.name, inactive=True)
+        define_domain(clone_domain_xml(xml, name, disk_path, guest_mac(name)))
+        clone.ipaddr = reserve_ipaddr(name, guest_mac(name))
+
+        # the guest OS has our public key authorized, share the private one
+        for suffix in ['', '.pub']:
+            shutil.copy(f'{self.ssh_keyfile_path}{suffix}', f'{clone.ssh_keyfile_path}{suffix}')
+        clone.ssh_pubkey = Path(f'{clone.ssh_keyfile_path}.pub').read_text().rstrip('\n')
+
+        clone.install_ready_path.write_text(clone.tag)
+
+        clone.disk_path = disk_path
+        clone.disk_format = 'qcow2'
+        return clone
+
+    def _wait_for_ipaddr(self):
+        """
+        Return the guest IP address, without waiting if the guest uses
+        an address reserved via reserve_ipaddr().
+        """
+        ipaddr = reserved_ipaddr(self.name, domain_mac(self.name))
+        if ipaddr:
+            return ipaddr
+        return wait_for_ifaddr(self.name)
+
     def _destroy_snapshotted(self):
         self.destroy()
-        self.snapshot_path.unlink(missing_ok=True)
+        # deleting a large overlay can take a while, do it in the background
+        if self.snapshot_path.exists():
+            old_path = self.snapshot_path.with_name(
+                f'{self.snapshot_path.name}.old-{uuid.uuid4().hex}',
+            )
+            self.snapshot_path.rename(old_path)
+            in_background(old_path.unlink)
+
+    def _stage_next_overlay(self, backing_path, backing_format):
+        """
+        Start creating an overlay for the next snapshot restore in the background,
+        to be picked up by _take_next_overlay().
+        """
+        next_path = self.snapshot_path.with_name(f'{self.name}-snap.next.qcow2')
+        cmd = [
+            'qemu-img', 'create', '-q', '-f', 'qcow2',
+            '-b', backing_path, '-F', backing_format,
+            next_path,
+        ]
+        key = (str(backing_path), backing_format, str(self.snapshot_path))
+        self._next_overlay = (key, next_path, in_background(subprocess.run, cmd, check=True))
+
+    def _take_next_overlay(self, backing_path, backing_format):
+        """
+        Move an overlay created by _stage_next_overlay() to the current snapshot
+        overlay path, if it was created for the same backing disk and path.
+        Return True if it was.
+        """
+        if not self._next_overlay:
+            return False
+        key, next_path, future = self._next_overlay
+        self._next_overlay = None
+        try:
+            future.result()
+        except subprocess.CalledProcessError:
+            next_path.unlink(missing_ok=True)
+            return False
+        if key != (str(backing_path), backing_format, str(self.snapshot_path)):
+            next_path.unlink(missing_ok=True)
+            return False
+        next_path.rename(self.snapshot_path)
+        return True
+
+    def _discard_next_overlay(self):
+        if not self._next_overlay:
+            return
+        _, next_path, future = self._next_overlay
+        self._next_overlay = None
+        with contextlib.suppress(subprocess.CalledProcessError):
+            future.result()
+        next_path.unlink(missing_ok=True)
 
     def _restore_original_disk(self):
         self._destroy_snapshotted()
+        self._discard_next_overlay()
         self.disk_path, self.disk_format = get_domain_base_image_disk(self.name)
         util.log(f"restoring {self.name} original base image disk: {self.disk_path}")
-        self.state_file_path.unlink(missing_ok=True)
+        # keep the state file, for use by the next prepare_for_snapshot()
         self.snapshot_ready = False
 
+    def _state_identity(self):
+        """
+        Return a dict describing the guest the state file is valid for;
+        any change to the base image disk (ie. by booting from it) or
+        to the domain RAM size invalidates the state file.
+        """
+        stat = self.disk_path.stat()
+        domain = ET.fromstring(domain_xml(self.name, inactive=True))
+        memory = domain.find('currentMemory')
+        return {
+            'tag': self.tag,
+            'disk_path': str(self.disk_path),
+            'disk_inode': stat.st_ino,
+            'disk_mtime': stat.st_mtime_ns,
+            'disk_size': stat.st_size,
+            'memory': f'{memory.text} {memory.get("unit")}',
+        }
+
+    def _reuse_state_file(self):
+        if not self.state_file_path.exists() or not self.state_meta_path.exists():
+            return False
+        meta = json.loads(self.state_meta_path.read_text())
+        ipaddr = meta.pop('ipaddr', None)
+        state_id = meta.pop('state_id', None)
+        if meta != self._state_identity():
+            util.log(f"discarding outdated {self.state_file_path}")
+            self.state_file_path.unlink()
+            self.state_meta_path.unlink()
+            self._remove_checkpoints()
+            return False
+        util.log(f"re-using {self.state_file_path} from a previous snapshot preparation")
+        self.ipaddr = ipaddr
+        self.state_id = state_id
+        return True
+
     def prepare_for_snapshot(self):
         if not self.is_installed():
             raise RuntimeError(f"guest {self.name} not installed or installed with different tag")
@@ -639,51 +1299,208 @@ class Guest:
         if not self.disk_path:
             self._restore_original_disk()
 
+        # skip the boot + save if an earlier test already did it
+        if self._reuse_state_file():
+            self.snapshot_ready = True
+            return
+
         # do guest first boot, let it settle and finish firstboot tasks
-        self.start()
-        if not self.ipaddr:
-            self.ipaddr = wait_for_ifaddr(self.name)
-        wait_for_ssh(self.ipaddr)
-        util.log("sleeping for 30sec for firstboot to settle")
-        time.sleep(30)
-        # then shut it down + start again, to get the lowest possible page cache
-        # (resulting in smallest possible RAM image)
-        # - disable for now, the ~200M saved RAM is not worth the ~2 minutes
-        #util.log(f"waiting for clean shutdown of {self.name}")
-        #self.shutdown()  # clean shutdown
-        #util.log(f"starting {self.name} back up")
-        #self.start()
-        #ip = wait_for_ifaddr(self.name)
-        #wait_for_ssh(ip)
-        #util.log("sleeping for 30sec for second boot to settle, for imaging")
-        #time.sleep(30)  # fully finish booting (ssh starts early)
+        with timed('boot', self.name):
+            self.start()
+            if not self.ipaddr:
+                self.ipaddr = self._wait_for_ipaddr()
+            self._wait_for_ssh()
+        with timed('settle', self.name):
+            self._wait_for_settle()
+            # then drop the page cache, to get the smallest possible RAM image,
+            # making every later restore of it faster
+            self.ssh('sync && echo 3 > /proc/sys/vm/drop_caches', check=True)
 
         # save a running domain (RAM, but not disk state) to a state file
         # so that it can be restored later
-        virsh('save', self.name, self.state_file_path, check=True)
+        self._ssh_master_stop()
+        with timed('save', self.name):
+            virsh('save', self.name, self.state_file_path, check=True)
+        # the saved guest isn't running, don't hold its resources until a restore
+        release_guest_slot(self.name)
 
         # modify domain's built-in XML to point to a snapshot-style disk path
         set_image_disk_in_state_file(self.state_file_path, self.snapshot_path, 'qcow2')
 
+        # any checkpoints were derived from a previous state file
+        self._remove_checkpoints()
+        self.state_id = uuid.uuid4().hex
+
+        meta = self._state_identity()
+        meta['ipaddr'] = self.ipaddr
+        meta['state_id'] = self.state_id
+        self.state_meta_path.write_text(json.dumps(meta))
+
         self.snapshot_ready = True
 
-    def _restore_snapshotted(self):
+    def _wait_for_settle(self, timeout=600):
+        """
+        Wait for the guest to finish booting, incl. firstboot tasks,
+        ie. for systemd to have no more queued jobs.
+
+        Only log (don't fail) if it doesn't settle within 'timeout' seconds.
+        """
+        util.log(f"waiting for {self.name} to finish booting")
+        # poll instead of using 'is-system-running --wait', which needs
+        # systemd 240+ (RHEL-8 has 239)
+        script = util.dedent(r'''
+            while state=$(systemctl is-system-running)
+                  [[ $state == initializing || $state == starting ]]; do
+                sleep 1
+            done
+            echo "$state"
+        ''')
+        proc = self.ssh(
+            f'timeout {timeout} bash -c {shlex.quote(script)}',
+            stdout=subprocess.PIPE, universal_newlines=True,
+        )
+        # 'degraded' just means some unit failed, which is not our business here
+        state = proc.stdout.strip()
+        if state not in ['running', 'degraded']:
+            util.log(f"{self.name} did not settle, systemd state: {state or 'unknown'}")
+
+    def _snapshot_overlay_path(self):
+        """
+        Return a path for a new snapshot overlay, in CONTEST_SNAPSHOT_DIR
+        if specified and if it has enough free space.
+        """
+        default = Path(f'{GUEST_IMG_DIR}/{self.name}-snap.qcow2')
+        snapshot_dir = os.environ.get('CONTEST_SNAPSHOT_DIR')
+        if not snapshot_dir:
+            return default
+        try:
+            Path(snapshot_dir).mkdir(parents=True, exist_ok=True)
+            free = shutil.disk_usage(snapshot_dir).free
+        except OSError as e:
+            util.log(f"cannot use {snapshot_dir}: {e}, using {GUEST_IMG_DIR}")
+            return default
+        min_free = os.environ.get('CONTEST_SNAPSHOT_DIR_MIN_FREE')
+        min_free = float(min_free) * 1024**3 if min_free else SNAPSHOT_DIR_MIN_FREE
+        if free < min_free:
+            util.log(f"only {free} bytes free in {snapshot_dir}, using {GUEST_IMG_DIR}")
+            return default
+        return Path(snapshot_dir) / default.name
+
+    def _prepare_restore(self, checkpoint=None):
+        """
+        Create a new snapshot overlay and return a tuple of (state file,
+        domain XML) to restore the guest from.
+        """
         self._destroy_snapshotted()
+        self.snapshot_path = self._snapshot_overlay_path()
+
+        if checkpoint:
+            if not self.has_checkpoint(checkpoint):
+                raise RuntimeError(f"checkpoint {checkpoint} of {self.name} does not exist")
+            state_file = self._checkpoint_state_path(checkpoint)
+            # checkpoint state files point to the checkpoint disk itself
+            backing_path, backing_format = get_image_disk_from_state_file(state_file)
+        else:
+            state_file = self.state_file_path
+            backing_path, backing_format = self.disk_path, self.disk_format
 
         cmd = [
             'qemu-img', 'create', '-q', '-f', 'qcow2',
-            '-b', self.disk_path, '-F', self.disk_format,
+            '-b', backing_path, '-F', backing_format,
             self.snapshot_path,
         ]
-        subprocess.run(cmd, check=True)
+        with timed('overlay-create', self.name):
+            if not self._take_next_overlay(backing_path, backing_format):
+                subprocess.run(cmd, check=True)
+        # and prepare another one for the next restore, while this one runs
+        self._stage_next_overlay(backing_path, backing_format)
+
+        # the state file might have been saved with a different overlay path
+        xml = save_image_xml(state_file)
+        saved_path, _ = get_image_disk_from_xml(xml)
+        if saved_path != self.snapshot_path:
+            xml = set_image_disk_in_xml(xml, self.snapshot_path, 'qcow2').decode()
+        # let KSM merge RAM pages of guests restored from the same state file
+        if '<nosharepages' in xml:
+            xml = allow_page_sharing_xml(xml).decode()
+        return (state_file, xml)
+
+    def _restore_snapshotted(self, checkpoint=None):
+        state_file, xml = self._prepare_restore(checkpoint)
+        acquire_guest_slot(self.name, *domain_resources(xml))
+        with timed('restore', self.name, checkpoint=checkpoint):
+            restore_domain(state_file, xml)
+
+    def _checkpoint_state_path(self, name):
+        if not re.fullmatch(r'[\w.-]+', name):
+            raise ValueError(f"invalid checkpoint name: {name}")
+        return Path(f'{GUEST_IMG_DIR}/{self.name}-ckpt-{name}.state')
+
+    def has_checkpoint(self, name):
+        """
+        Return True if a checkpoint 'name' exists and was created from
+        the current snapshot state (see prepare_for_snapshot()).
+        """
+        if self.state_id is None:
+            return False
+        state_file = self._checkpoint_state_path(name)
+        meta_file = state_file.with_suffix('.json')
+        disk_file = state_file.with_suffix('.qcow2')
+        if not all(f.exists() for f in (state_file, meta_file, disk_file)):
+            return False
+        return json.loads(meta_file.read_text()).get('state_id') == self.state_id
+
+    def checkpoint(self, name):
+        """
+        Save the current RAM and disk state of a snapshotted guest as
+        a checkpoint 'name', to be later restored via
+        snapshotted(from_checkpoint=name), and continue running.
 
-        virsh('restore', self.state_file_path, check=True)
+        The disk state is kept as a qcow2 overlay chained on top of the
+        snapshot overlay, so checkpoints can be nested, ie. a checkpoint can
+        be taken inside a guest restored from another checkpoint.
+
+        Checkpoints are kept across tests sharing the guest 'tag', for as long
+        as the snapshot state they were created from, so a test can create one
+        only if not has_checkpoint(name).
+        """
+        if (
+            guest_domstate(self.name) != 'running'
+            or get_image_disk_from_xml(domain_xml(self.name))[0] != self.snapshot_path
+        ):
+            raise RuntimeError(
+                f"guest {self.name} is not running from a snapshot, "
+                "checkpoint() can be used only inside snapshotted()",
+            )
+        state_file = self._checkpoint_state_path(name)
+        if self.has_checkpoint(name):
+            raise RuntimeError(f"checkpoint {name} of {self.name} already exists")
+        # of an outdated snapshot state, if any
+        state_file.unlink(missing_ok=True)
+        # not in CONTEST_SNAPSHOT_DIR, checkpoints outlive a single test and
+        # would otherwise fill up a (possibly tmpfs) snapshot dir
+        disk_path = state_file.with_suffix('.qcow2')
+        util.log(f"saving {self.name} as checkpoint {name}")
+        self._ssh_master_stop()
+        virsh('save', self.name, state_file, check=True)
+        release_guest_slot(self.name)
+        # the overlay is not written to anymore, make it the checkpoint disk
+        shutil.move(self.snapshot_path, disk_path)
+        set_image_disk_in_state_file(state_file, disk_path, 'qcow2')
+        state_file.with_suffix('.json').write_text(json.dumps({'state_id': self.state_id}))
+        self._restore_snapshotted(checkpoint=name)
+        self._wait_for_ssh()
+
+    def _remove_checkpoints(self):
+        for f in Path(GUEST_IMG_DIR).glob(f'{self.name}-ckpt-*'):
+            f.unlink()
 
     def cleanup_snapshot(self):
         if os.environ.get('CONTEST_LEAVE_GUEST_RUNNING') == '1':
             self._log_leave_running_notice()
             return
 
+        # keep checkpoints for other tests, see checkpoint()
         self._restore_original_disk()
 
     @staticmethod
@@ -696,9 +1513,12 @@ class Guest:
         util.log(textwrap.indent(out, '    '), skip_frames=1)
 
     @contextlib.contextmanager
-    def snapshotted(self):
+    def snapshotted(self, *, from_checkpoint=None):
         """
         Create a snapshot, restore the guest, ready it for communication.
+
+        If 'from_checkpoint' is specified, restore the guest from a named
+        checkpoint (see checkpoint()) instead of the freshly booted state.
         """
         if not self.is_installed():
             raise RuntimeError(f"guest {self.name} not installed or installed with different tag")
@@ -707,23 +1527,48 @@ class Guest:
                 f"guest {self.name} not prepared for snapshotting, "
                 "prepare_for_snapshot() needs to be used first",
             )
-        self._restore_snapshotted()
-        wait_for_ssh(self.ipaddr)
-        yield self
+        self._restore_snapshotted(from_checkpoint)
+        self._wait_for_ssh()
+        try:
+            yield self
+        finally:
+            self._ssh_master_stop()
 
     @contextlib.contextmanager
-    def booted(self, *, safe_shutdown=False):
+    def booted(self, *, safe_shutdown=False, shared_dirs=None):
         """
         Just boot the guest, ready it for communication.
 
         With 'safe_shutdown', guarantee that the guest shuts down cleanly.
         This is useful for setup-style use cases where the test wants to modify
         the guest before taking a snapshot.
+
+        'shared_dirs' is an optional dict of guest paths to host directories,
+        which are shared read-only via virtiofs and mounted on the guest paths,
+        so that large inputs (content, tests, datastreams) don't need to be
+        copied to the guest. This needs virtiofsd and libvirt with read-only
+        virtiofs support, see Host.check_virtiofs().
+        This is available only for booted() guests, not snapshotted() ones,
+        as QEMU cannot save a guest with virtiofs devices, and adding them
+        on restore makes the saved RAM image incompatible.
         """
-        self.start()
+        if shared_dirs:
+            Host.check_virtiofs()
+            # the domain stays as it was, only this boot has the shared dirs
+            orig_xml = domain_xml(self.name, inactive=True)
+            define_domain(shared_dirs_domain_xml(orig_xml, shared_dirs))
+            try:
+                self.start()
+            finally:
+                define_domain(orig_xml)
+        else:
+            self.start()
         if not self.ipaddr:
-            self.ipaddr = wait_for_ifaddr(self.name)
-        wait_for_ssh(self.ipaddr)
+            self.ipaddr = self._wait_for_ipaddr()
+        self._wait_for_ssh()
+        for tag, guest_path in shared_dirs_tags(shared_dirs):
+            path = shlex.quote(str(guest_path))
+            self.ssh(f'mkdir -p {path} && mount -t virtiofs -o ro {tag} {path}', check=True)
         try:
             yield self
         finally:
@@ -741,42 +1586,117 @@ class Guest:
                         util.log(f"shutdown timed out, destroying {self.name}")
                         self.destroy()
 
-    def _do_ssh(self, *cmd, func=util.subprocess_run, **run_args):
-        ssh_cmdline = [
-            'ssh', '-q', '-i', self.ssh_keyfile_path, '-o', 'BatchMode=yes',
+    def _ssh_options(self, master=False):
+        # use the persistent connection if it exists, connect directly if not
+        options = [
+            '-i', self.ssh_keyfile_path, '-o', 'BatchMode=yes',
             '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null',
-            f'{GUEST_SSH_USER}@{self.ipaddr}', '--', *cmd,
+            '-o', 'ConnectTimeout=30',
+            '-o', f'ControlPath={self.ssh_control_path}',
+            '-o', f'ControlMaster={"yes" if master else "no"}',
+        ]
+        if master:
+            # make the master exit if the guest dies (crash, reset, etc.),
+            # rather than hanging all multiplexed clients on a dead connection
+            options += ['-o', 'ServerAliveInterval=5', '-o', 'ServerAliveCountMax=3']
+        return options
+
+    def _wait_for_ssh(self):
+        """
+        Wait for ssh on the guest and open a persistent (master) connection
+        to it, to be re-used by any further ssh/scp/rsync, avoiding a full
+        connection setup and key exchange for each of them.
+
+        If using vsock, just wait for the guest vsock agent instead.
+        """
+        if self.vsock:
+            with timed('wait-for-ssh', self.name, vsock=True):
+                self.vsock_cid = domain_vsock_cid(self.name)
+                util.wait_for_vsock(self.vsock_cid, GUEST_VSOCK_PORT)
+            return
+        with timed('wait-for-ssh', self.name):
+            wait_for_ssh(self.ipaddr)
+        self._ssh_master_stop()
+        ret = subprocess.run(
+            self._ssh_master_cmdline(), stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+        )
+        if ret.returncode != 0:
+            util.log(f"could not open a persistent ssh connection to {self.name}")
+
+    def _ssh_master_cmdline(self):
+        # -f forks ssh into the background only once it is connected, so
+        # waiting for the foreground process waits for the connection
+        return [
+            'ssh', '-q', *self._ssh_options(master=True), '-o', 'ControlPersist=yes',
+            '-f', '-N', f'{GUEST_SSH_USER}@{self.ipaddr}',
         ]
+
+    def _ssh_master_stop(self):
+        if not self.ssh_control_path.exists():
+            return
+        cmd = [
+            'ssh', '-q', '-o', f'ControlPath={self.ssh_control_path}', '-O', 'exit',
+            f'{GUEST_SSH_USER}@{self.ipaddr}',
+        ]
+        subprocess.run(cmd, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+        self.ssh_control_path.unlink(missing_ok=True)
+
+    def _ssh_cmdline(self, *cmd):
+        if self.vsock:
+            # -I to not add lib/util to sys.path, shadowing stdlib modules
+            return [
+                sys.executable, '-I', util.libdir / 'util' / 'vsock.py',
+                str(self.vsock_cid), str(GUEST_VSOCK_PORT), '--', *cmd,
+            ]
+        else:
+            return [
+                'ssh', '-q', *self._ssh_options(),
+                f'{GUEST_SSH_USER}@{self.ipaddr}', '--', *cmd,
+            ]
+
+    def _do_ssh(self, *cmd, func=util.subprocess_run, **run_args):
         if run_args.get('check') and run_args.get('stderr') is None:
             run_args['stderr'] = subprocess.PIPE
-        return func(ssh_cmdline, **run_args)
+        return func(self._ssh_cmdline(*cmd), **run_args)
 
     def ssh(self, *cmd, **kwargs):
         """Run a command via ssh(1) inside the guest."""
-        return self._do_ssh(*cmd, **kwargs)
+        with timed('ssh', self.name, cmd=' '.join(str(x) for x in cmd)[:200]):
+            return self._do_ssh(*cmd, **kwargs)
 
     def ssh_stream(self, *cmd, **kwargs):
         return self._do_ssh(*cmd, func=util.subprocess_stream, **kwargs)
 
     def _do_scp(self, *args):
-        cmd = [
-            'scp', '-q', '-i', self.ssh_keyfile_path, '-o', 'BatchMode=yes',
-            '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null',
-            *args,
-        ]
+        cmd = ['scp', '-q', *self._ssh_options(), *args]
         return util.subprocess_run(cmd, check=True, stderr=subprocess.PIPE)
 
     def copy_from(self, remote_file, local_file='.'):
+        if self.vsock:
+            local_file = Path(local_file)
+            if local_file.is_dir():
+                local_file /= PurePosixPath(remote_file).name
+            with open(local_file, 'wb') as f:
+                self._do_ssh('cat', shlex.quote(str(remote_file)), stdout=f, check=True)
+            return
         self._do_scp(f'{GUEST_SSH_USER}@{self.ipaddr}:{remote_file}', local_file)
 
     def copy_to(self, local_file, remote_file='.'):
+        if self.vsock:
+            with open(local_file, 'rb') as f:
+                self._do_ssh(self._vsock_copy_to_cmd(local_file, remote_file), stdin=f, check=True)
+            return
         self._do_scp(local_file, f'{GUEST_SSH_USER}@{self.ipaddr}:{remote_file}')
 
+    @staticmethod
+    def _vsock_copy_to_cmd(local_file, remote_file):
+        # like scp, copy into 'remote_file' if it is a directory
+        name = shlex.quote(Path(local_file).name)
+        remote = shlex.quote(str(remote_file))
+        return f'f={remote}; [ -d "$f" ] && f="$f/"{name}; cat > "$f"'
+
     def _do_rsync(self, *args):
-        ssh = (
-            f'ssh -q -i {self.ssh_keyfile_path}'
-            ' -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null'
-        )
+        ssh = ' '.join(str(x) for x in ['ssh', '-q', *self._ssh_options()])
         return util.subprocess_run(
             ['rsync', '-a', '-e', ssh, *args], check=True, stderr=subprocess.PIPE,
         )
@@ -795,6 +1715,69 @@ class Guest:
             local_args = (local_path,)
         self._do_rsync(*rsync_opts, *local_args, f'{GUEST_SSH_USER}@{self.ipaddr}:{remote_path}')
 
+    @staticmethod
+    def _tar_compress_args(compress):
+        if not compress:
+            return []
+        if compress not in TAR_COMPRESSORS:
+            raise ValueError(f"unknown compression: {compress}")
+        return [f'--use-compress-program={TAR_COMPRESSORS[compress]}']
+
+    def tar_to(self, local_path, remote_dir='.', compress=None):
+        """
+        Copy one or more local files/directories into 'remote_dir' inside
+        the guest, as one tar stream over one ssh channel.
+
+        'compress' can be any of TAR_COMPRESSORS, to compress the stream
+        on the fly (the compressor must be installed in the guest too).
+        """
+        if isinstance(local_path, (tuple,list)):
+            local_paths = local_path
+        else:
+            local_paths = (local_path,)
+        compress_args = self._tar_compress_args(compress)
+        create = ['tar', '-c', '-f', '-', *compress_args]
+        for path in local_paths:
+            path = Path(path).absolute()
+            create += ['-C', str(path.parent), path.name]
+        extract = ['tar', '-x', '-f', '-', *compress_args, '-C', str(remote_dir)]
+        remote_cmd = f'mkdir -p {shlex.quote(str(remote_dir))} && {shlex.join(extract)}'
+        tar = util.subprocess_Popen(create, stdout=PIPE)
+        try:
+            self.ssh(remote_cmd, stdin=tar.stdout, check=True)
+        finally:
+            tar.stdout.close()
+            tar.wait()
+        if tar.returncode != 0:
+            raise subprocess.CalledProcessError(tar.returncode, create)
+
+    def tar_from(self, remote_path, local_dir='.', compress=None):
+        """
+        Copy one or more files/directories from inside the guest into
+        'local_dir', as one tar stream over one ssh channel.
+
+        'compress' works like for tar_to().
+        """
+        if isinstance(remote_path, (tuple,list)):
+            remote_paths = remote_path
+        else:
+            remote_paths = (remote_path,)
+        compress_args = self._tar_compress_args(compress)
+        create = ['tar', '-c', '-f', '-', *compress_args]
+        for path in remote_paths:
+            path = PurePosixPath(path)
+            create += ['-C', str(path.parent), path.name]
+        Path(local_dir).mkdir(parents=True, exist_ok=True)
+        extract = ['tar', '-x', '-f', '-', *compress_args, '-C', str(local_dir)]
+        ssh = self._do_ssh(shlex.join(create), func=util.subprocess_Popen, stdout=PIPE)
+        try:
+            util.subprocess_run(extract, stdin=ssh.stdout, check=True, stderr=PIPE)
+        finally:
+            ssh.stdout.close()
+            ssh.wait()
+        if ssh.returncode != 0:
+            raise subprocess.CalledProcessError(ssh.returncode, ssh.args)
+
     def generate_ssh_keypair(self):
         private = self.ssh_keyfile_path
         # don't use .with_suffix() as it would destroy anything after first '.'
@@ -814,11 +1797,10 @@ class Guest:
         request = {'execute': cmd}
         if args:
             request['arguments'] = args
-        ret = virsh('qemu-agent-command', self.name, json.dumps(request), check=not blind,
-                    text=True, stdout=PIPE, stderr=DEVNULL if blind else None)
+        reply = qemu_agent_command(self.name, json.dumps(request), blind=blind)
         if blind:
             return
-        return json.loads(ret.stdout)['return']
+        return json.loads(reply)['return']
 
     def wipe(self):
         """
@@ -828,13 +1810,297 @@ class Guest:
         or just to remove any leftovers after using a one-time guest.
         """
         self.destroy()
+        self._discard_next_overlay()
         self.undefine(incl_storage=True)
         files = [
             self.ssh_keyfile_path, Path(f'{self.ssh_keyfile_path}.pub'),
-            self.snapshot_path, self.state_file_path, self.install_ready_path,
+            self.state_file_path, self.state_meta_path,
+            self.install_ready_path,
+            self.ssh_control_path,
         ]
+        # snapshot overlays, incl. pre-created and not yet deleted ones
+        snapshot_dirs = [GUEST_IMG_DIR]
+        if snapshot_dir := os.environ.get('CONTEST_SNAPSHOT_DIR'):
+            snapshot_dirs.append(snapshot_dir)
+        for snapshot_dir in snapshot_dirs:
+            files += Path(snapshot_dir).glob(f'{self.name}-snap.*')
         for f in files:
             f.unlink(missing_ok=True)
+        self._remove_checkpoints()
+
+
+class AsyncGuest:
+    """
+    An asyncio counterpart of the snapshotted() and ssh-related API of Guest,
+    for driving many guests (ie. clones) from one process without threads.
+
+    It wraps an existing Guest instance, which is used for everything else,
+    incl. installation and prepare_for_snapshot():
+
+        async def scan(guest):
+            ag = virt.AsyncGuest(guest)
+            async with ag.snapshotted():
+                await ag.ssh('oscap', 'xccdf', 'eval', ..., check=True)
+                await ag.copy_from('report.html', f'{guest.name}.html')
+
+        async def scan_all(guests):
+            await asyncio.gather(*(scan(g) for g in guests))
+
+        asyncio.run(scan_all(clones))
+
+    Anything that waits (guest restore, guest boot, running commands) is done
+    asynchronously, any blocking preparations (ie. snapshot overlay creation
+    or host resource accounting) run in a thread, off the event loop.
+    """
+
+    def __init__(self, guest):
+        self.guest = guest
+
+    @staticmethod
+    async def _run(cmd, *, check=False, input=None, stdin=None, stdout=None, stderr=None,
+                   text=False, universal_newlines=False, **kwargs):
+        """
+        Like util.subprocess_run(), returning subprocess.CompletedProcess.
+
+        Any extra 'kwargs' (ie. 'cwd' or 'env') are passed to
+        asyncio.create_subprocess_exec().
+        """
+        util.log(f"running: {' '.join(str(x) for x in cmd)}", skip_frames=1)
+        text = text or universal_newlines
+        if input is not None:
+            stdin = PIPE
+            if text:
+                input = input.encode()
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, stdin=stdin, stdout=stdout, stderr=stderr, **kwargs,
+        )
+        out, err = await proc.communicate(input)
+        if text:
+            out = out.decode() if out is not None else None
+            err = err.decode() if err is not None else None
+        if check and proc.returncode != 0:
+            raise util.VerboseCalledProcessError(proc.returncode, cmd, out, err)
+        return subprocess.CompletedProcess(cmd, proc.returncode, out, err)
+
+    async def _acquire_guest_slot(self, ram, vcpus, timeout=3600):
+        end_time = time.monotonic() + timeout
+        # the ledger is guarded by a flock, which can block
+        while not await asyncio.to_thread(try_acquire_guest_slot, self.guest.name, ram, vcpus):
+            if time.monotonic() > end_time:
+                raise TimeoutError(f"host resources for {self.guest.name} not available")
+            await asyncio.sleep(5)
+
+    async def _wait_for_ssh(self):
+        guest = self.guest
+        if guest.vsock:
+            guest.vsock_cid = await asyncio.to_thread(domain_vsock_cid, guest.name)
+            await util.async_wait_for_vsock(guest.vsock_cid, GUEST_VSOCK_PORT)
+            return
+        await util.async_wait_for_tcp(guest.ipaddr, 22, compare=b'SSH-')
+        await asyncio.to_thread(guest._ssh_master_stop)
+        ret = await self._run(
+            guest._ssh_master_cmdline(), stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL,
+        )
+        if ret.returncode != 0:
+            util.log(f"could not open a persistent ssh connection to {guest.name}")
+
+    @contextlib.asynccontextmanager
+    async def snapshotted(self, *, from_checkpoint=None):
+        """Like Guest.snapshotted(), but asynchronous."""
+        guest = self.guest
+        if not guest.is_installed():
+            raise RuntimeError(f"guest {guest.name} not installed or installed with different tag")
+        if not guest.snapshot_ready:
+            raise RuntimeError(
+                f"guest {guest.name} not prepared for snapshotting, "
+                "prepare_for_snapshot() needs to be used first",
+            )
+        # destroys the previous domain and creates a new overlay, which block
+        state_file, xml = await asyncio.to_thread(guest._prepare_restore, from_checkpoint)
+        await self._acquire_guest_slot(*domain_resources(xml))
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.xml') as f:
+            f.write(xml)
+            f.flush()
+            cmd = ['virsh', '--quiet', 'restore', state_file, '--xml', f.name]
+            with timed('restore', guest.name, checkpoint=from_checkpoint):
+                await self._run(cmd, check=True, stderr=PIPE)
+        with timed('wait-for-ssh', guest.name):
+            await self._wait_for_ssh()
+        try:
+            yield self
+        finally:
+            await asyncio.to_thread(guest._ssh_master_stop)
+
+    async def ssh(self, *cmd, **kwargs):
+        """Run a command inside the guest, see Guest.ssh()."""
+        if kwargs.get('check') and kwargs.get('stderr') is None:
+            kwargs['stderr'] = PIPE
+        return await self._run(self.guest._ssh_cmdline(*cmd), **kwargs)
+
+    async def copy_from(self, remote_file, local_file='.'):
+        guest = self.guest
+        if guest.vsock:
+            local_file = Path(local_file)
+            if local_file.is_dir():
+                local_file /= PurePosixPath(remote_file).name
+            ret = await self.ssh('cat', shlex.quote(str(remote_file)), stdout=PIPE, check=True)
+            local_file.write_bytes(ret.stdout)
+            return
+        cmd = [
+            'scp', '-q', *guest._ssh_options(),
+            f'{GUEST_SSH_USER}@{guest.ipaddr}:{remote_file}', local_file,
+        ]
+        await self._run(cmd, check=True, stderr=PIPE)
+
+    async def copy_to(self, local_file, remote_file='.'):
+        guest = self.guest
+        if guest.vsock:
+            cmd = guest._vsock_copy_to_cmd(local_file, remote_file)
+            await self.ssh(cmd, input=Path(local_file).read_bytes(), check=True)
+            return
+        cmd = [
+            'scp', '-q', *guest._ssh_options(),
+            local_file, f'{GUEST_SSH_USER}@{guest.ipaddr}:{remote_file}',
+        ]
+        await self._run(cmd, check=True, stderr=PIPE)
+
+
+#
+# libvirt API access, via a connection shared across the whole test,
+# falling back to 'virsh' if libvirt python bindings are not installed
+#
+
+_libvirt_conn = None
+
+# libvirt.VIR_DOMAIN_* states, as printed by 'virsh domstate'
+_domain_states = [
+    'no state', 'running', 'idle', 'paused', 'in shutdown', 'shut off', 'crashed',
+    'pmsuspended',
+]
+
+
+def libvirt_connection():
+    """
+    Return an open libvirt connection, shared by all callers, or None
+    if the libvirt python bindings are not available.
+    """
+    global _libvirt_conn
+    if libvirt is None:
+        return None
+    if _libvirt_conn is None or not _libvirt_conn.isAlive():
+        # same default URI as virsh(1) would use
+        _libvirt_conn = libvirt.open(None)
+    return _libvirt_conn
+
+
+def _lookup_domain(name):
+    """Return a libvirt.virDomain for 'name', or None if it is not defined."""
+    try:
+        return libvirt_connection().lookupByName(name)
+    except libvirt.libvirtError as e:
+        if e.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+            return None
+        raise
+
+
+def domain_xml(name, *, inactive=False):
+    """Return the XML definition of a domain, as a string."""
+    if libvirt_connection():
+        flags = libvirt.VIR_DOMAIN_XML_INACTIVE if inactive else 0
+        return libvirt_connection().lookupByName(name).XMLDesc(flags)
+    args = ['--inactive'] if inactive else []
+    ret = virsh('dumpxml', name, *args, stdout=PIPE, check=True, text=True)
+    return ret.stdout
+
+
+def network_xml(name):
+    """Return the XML definition of a libvirt network, as a string."""
+    if libvirt_connection():
+        return libvirt_connection().networkLookupByName(name).XMLDesc(0)
+    ret = virsh('net-dumpxml', name, stdout=PIPE, check=True, text=True)
+    return ret.stdout
+
+
+def define_domain(xmlstr):
+    """Define (or re-define) a persistent domain from an XML string or bytes."""
+    if isinstance(xmlstr, bytes):
+        xmlstr = xmlstr.decode()
+    if libvirt_connection():
+        libvirt_connection().defineXML(xmlstr)
+        return
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.xml') as f:
+        f.write(xmlstr)
+        f.flush()
+        virsh('define', f.name, check=True)
+
+
+def destroy_domain(name):
+    """Forcefully stop a running domain."""
+    if libvirt_connection():
+        libvirt_connection().lookupByName(name).destroy()
+    else:
+        virsh('destroy', name, check=True)
+
+
+def restore_domain(state_file, xmlstr=None):
+    """
+    Restore (start) a domain from a saved RAM image state file,
+    optionally overriding the domain XML stored in it with 'xmlstr'.
+    """
+    if isinstance(xmlstr, bytes):
+        xmlstr = xmlstr.decode()
+    if libvirt_connection():
+        libvirt_connection().restoreFlags(str(state_file), xmlstr, 0)
+        return
+    if xmlstr is None:
+        virsh('restore', state_file, check=True)
+        return
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.xml') as f:
+        f.write(xmlstr)
+        f.flush()
+        virsh('restore', state_file, '--xml', f.name, check=True)
+
+
+def save_image_xml(state_file):
+    """Return the domain XML stored inside a saved RAM image state file."""
+    if libvirt_connection():
+        return libvirt_connection().saveImageGetXMLDesc(str(state_file), 0)
+    ret = virsh('save-image-dumpxml', state_file, stdout=PIPE, check=True, text=True)
+    return ret.stdout
+
+
+def save_image_define(state_file, xmlstr):
+    """Replace the domain XML inside a saved RAM image state file."""
+    if isinstance(xmlstr, bytes):
+        xmlstr = xmlstr.decode()
+    if libvirt_connection():
+        libvirt_connection().saveImageDefineXML(str(state_file), xmlstr, 0)
+        return
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.xml') as f:
+        f.write(xmlstr)
+        f.flush()
+        virsh('save-image-define', state_file, f.name, check=True)
+
+
+def qemu_agent_command(name, request, *, blind=False):
+    """
+    Send a JSON 'request' string to qemu-guest-agent of a domain and return
+    the JSON reply string, or None if 'blind'.
+    """
+    if libvirt_connection():
+        domain = libvirt_connection().lookupByName(name)
+        if blind:
+            with contextlib.suppress(libvirt.libvirtError):
+                libvirt_qemu.qemuAgentCommand(
+                    domain, request, libvirt_qemu.VIR_DOMAIN_QEMU_AGENT_COMMAND_NOWAIT, 0,
+                )
+            return None
+        return libvirt_qemu.qemuAgentCommand(
+            domain, request, libvirt_qemu.VIR_DOMAIN_QEMU_AGENT_COMMAND_DEFAULT, 0,
+        )
+    ret = virsh('qemu-agent-command', name, request, check=not blind,
+                text=True, stdout=PIPE, stderr=DEVNULL if blind else None)
+    return None if blind else ret.stdout
 
 
 #
@@ -842,6 +2108,12 @@ class Guest:
 #
 
 def guest_domstate(name):
+    if libvirt_connection():
+        domain = _lookup_domain(name)
+        if not domain:
+            return ''
+        state, _ = domain.state()
+        return _domain_states[state]
     ret = virsh('domstate', name, stdout=PIPE, stderr=DEVNULL, text=True)
     if ret.returncode != 0:  # not defined
         return ''
@@ -854,11 +2126,31 @@ def wait_for_domstate(name, state, timeout=300):
     ('running', 'shut off', etc.).
     """
     util.log(f"waiting for {name} to be {state} for {timeout}sec")
-    end_time = datetime.now() + timedelta(seconds=timeout)
-    while datetime.now() < end_time:
-        if guest_domstate(name) == state:
-            return
-    raise TimeoutError(f"wait for {name} to be in {state} timed out")
+    end_time = time.monotonic() + timeout
+    # subscribe to domain lifecycle events and re-check the state only when
+    # libvirt reports a change, rather than busy-looping on 'virsh domstate'
+    # - as the subscription races with the initial state check, re-check
+    #   periodically anyway, just in case an event was missed
+    # - if 'virsh event' exits (ie. the domain got undefined), fall back
+    #   to plain polling
+    cmd = [
+        'virsh', '--quiet', 'event', '--domain', name, '--event', 'lifecycle',
+        '--loop', '--timeout', str(timeout),
+    ]
+    with subprocess.Popen(cmd, stdout=PIPE, stderr=DEVNULL, text=True) as proc:
+        try:
+            while guest_domstate(name) != state:
+                remaining = end_time - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"wait for {name} to be in {state} timed out")
+                if proc.poll() is not None:
+                    time.sleep(min(remaining, 1))
+                    continue
+                rlist, _, _ = select.select([proc.stdout], [], [], min(remaining, 5))
+                if rlist:
+                    proc.stdout.readline()
+        finally:
+            proc.terminate()
 
 
 #
@@ -869,6 +2161,14 @@ def domifaddr(name):
     """
     Return a guest's IP address, queried from libvirt.
     """
+    if libvirt_connection():
+        domain = libvirt_connection().lookupByName(name)
+        source = libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE
+        for iface in domain.interfaceAddresses(source).values():
+            for addr in iface['addrs'] or ():
+                if addr['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4:
+                    return addr['addr']
+        raise ConnectionError(f"guest {name} has no address assigned yet")
     ret = virsh('domifaddr', name, stdout=PIPE, text=True, check=True)
     first = ret.stdout.strip().split('\n')[0]  # in case of multiple interfaces
     if not first:
@@ -878,6 +2178,15 @@ def domifaddr(name):
     return addr
 
 
+def domain_vsock_cid(name):
+    """Return the vsock CID of a running guest."""
+    domain = ET.fromstring(domain_xml(name))
+    cid = domain.find('devices/vsock/cid')
+    if cid is None or not cid.get('address'):
+        raise RuntimeError(f"guest {name} has no vsock device")
+    return int(cid.get('address'))
+
+
 def wait_for_ifaddr(name, timeout=600, sleep=0.5):
     util.log(f"waiting for IP addr of {name} for up to {timeout}sec")
     end_time = datetime.now() + timedelta(seconds=timeout)
@@ -896,10 +2205,311 @@ def wait_for_ssh(host, port=22, *, to_shutdown=False):
         util.wait_for_tcp(host, port, compare=b'SSH-')
 
 
+#
+# reserved (static) guest addressing, so that guest IP addresses are known
+# before the guests even boot, without waiting for DHCP
+#
+
+@contextlib.contextmanager
+def _reservations_locked():
+    # shared by all tests on the host, not just this process
+    with open(RESERVATIONS_LOCK, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def guest_mac(name):
+    """Return a MAC address unique to a guest domain 'name'."""
+    digest = hashlib.sha256(name.encode()).digest()
+    # locally administered (0x52 = 0b01010010), with 32 bits of the hash
+    return '52:54:' + ':'.join(f'{x:02x}' for x in digest[:4])
+
+
+def domain_mac(name):
+    """Return the MAC address of the first network interface of a domain."""
+    domain = ET.fromstring(domain_xml(name, inactive=True))
+    mac = domain.find('devices/interface/mac')
+    if mac is None:
+        raise RuntimeError(f"guest {name} has no network interface MAC address")
+    return mac.get('address')
+
+
+def _dhcp_hosts(net_name):
+    net = ET.fromstring(network_xml(net_name))
+    return net.findall('ip/dhcp/host')
+
+
+def reserved_ipaddr(name, mac, net_name='default'):
+    """
+    Return an IP address reserved for a guest 'name' with 'mac',
+    or None if there is no reservation.
+    """
+    for host in _dhcp_hosts(net_name):
+        if host.get('name') == name and host.get('mac') == mac:
+            return host.get('ip')
+    return None
+
+
+def reserve_ipaddr(name, mac, net_name='default'):
+    """
+    Reserve an IP address for a guest 'name' with 'mac' as a static DHCP host
+    entry in a libvirt network, and return the address.
+
+    The address is picked from NETWORK_RESERVED_RANGE based on the guest name,
+    so that a guest gets the same address across tests, and any existing
+    reservation of the guest is re-used.
+    """
+    with _reservations_locked():
+        ipaddr = reserved_ipaddr(name, mac, net_name)
+        if ipaddr:
+            return ipaddr
+
+        used = set()
+        for host in _dhcp_hosts(net_name):
+            if host.get('mac') == mac and host.get('name') != name:
+                raise RuntimeError(
+                    f"MAC {mac} of {name} is already reserved for {host.get('name')}",
+                )
+            # remove a reservation for a different MAC (ie. re-installed guest)
+            if host.get('name') == name:
+                _delete_dhcp_host(host, net_name)
+            else:
+                used.add(host.get('ip'))
+
+        first, last = (ipaddress.IPv4Address(x) for x in NETWORK_RESERVED_RANGE)
+        size = int(last) - int(first) + 1
+        start = int.from_bytes(hashlib.sha256(name.encode()).digest()[:4], 'big')
+        for offset in range(size):
+            ipaddr = str(first + (start + offset) % size)
+            if ipaddr not in used:
+                break
+        else:
+            raise RuntimeError(f"no free address in {NETWORK_RESERVED_RANGE}")
+
+        util.log(f"reserving {ipaddr} for {name} ({mac})")
+        virsh(
+            'net-update', net_name, 'add-last', 'ip-dhcp-host',
+            f"<host mac='{mac}' name='{name}' ip='{ipaddr}'/>", '--live', '--config',
+            stdout=DEVNULL, check=True,
+        )
+        return ipaddr
+
+
+def release_ipaddr(name, net_name='default'):
+    """Remove any address reservations of a guest 'name'."""
+    with _reservations_locked():
+        for host in _dhcp_hosts(net_name):
+            if host.get('name') == name:
+                util.log(f"releasing {host.get('ip')} of {name}")
+                _delete_dhcp_host(host, net_name)
+
+
+def _delete_dhcp_host(host, net_name):
+    virsh(
+        'net-update', net_name, 'delete', 'ip-dhcp-host',
+        ET.tostring(host, encoding='unicode'), '--live', '--config',
+        stdout=DEVNULL, check=True,
+    )
+
+
+#
+# host capacity accounting, so that guests of concurrently running tests
+# don't overload the host
+#
+
+def host_capacity():
+    """Return a tuple of (RAM in MBs, CPU count) usable for guests."""
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemTotal:'):
+                total_ram = int(line.split()[1]) // 1024
+                break
+        else:
+            raise RuntimeError("MemTotal not found in /proc/meminfo")
+    return (total_ram - HOST_RESERVED_RAM, os.cpu_count())
+
+
+def domain_resources(name_or_xml):
+    """
+    Return a tuple of (RAM in MBs, vCPU count) of a domain, specified either
+    by name or as a domain XML string.
+    """
+    if name_or_xml.lstrip().startswith('<'):
+        domain = ET.fromstring(name_or_xml)
+    else:
+        domain = ET.fromstring(domain_xml(name_or_xml, inactive=True))
+    memory = domain.find('currentMemory')
+    if memory is None:
+        memory = domain.find('memory')
+    units = {'KiB': 1/1024, 'MiB': 1, 'GiB': 1024}
+    ram = int(int(memory.text) * units[memory.get('unit', 'KiB')])
+    return (ram, int(domain.find('vcpu').text))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextlib.contextmanager
+def _slots_ledger():
+    """
+    Yield a dict of guest slots (name -> resources) shared by all tests on
+    the host, saving any changes to it on exit.
+    """
+    ledger = Path(SLOTS_LEDGER)
+    with open(f'{ledger}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        slots = json.loads(ledger.read_text()) if ledger.exists() else {}
+        # forget guests of tests that ended without releasing them
+        slots = {k: v for k, v in slots.items() if _pid_alive(v['pid'])}
+        try:
+            yield slots
+        finally:
+            ledger.write_text(json.dumps(slots))
+
+
+def _slot_fits(slots, ram, vcpus):
+    # a guest alone on the host is always allowed to run, even if it is
+    # bigger than the host, so that tests work on small hosts as before
+    if not slots:
+        return True
+    total_ram, total_cpus = host_capacity()
+    if sum(x['ram'] for x in slots.values()) + ram > total_ram:
+        return False
+    if sum(x['vcpus'] for x in slots.values()) + vcpus > total_cpus:
+        return False
+    return shutil.disk_usage(GUEST_IMG_DIR).free >= HOST_MIN_FREE_DISK
+
+
+def try_acquire_guest_slot(name, ram, vcpus):
+    """
+    Like acquire_guest_slot(), but don't wait - return True if the resources
+    were reserved, False if they are not available.
+    """
+    with _slots_ledger() as slots:
+        slots.pop(name, None)
+        if not _slot_fits(slots, ram, vcpus):
+            return False
+        slots[name] = {'pid': os.getpid(), 'ram': ram, 'vcpus': vcpus}
+        return True
+
+
+def acquire_guest_slot(name, ram, vcpus, timeout=3600):
+    """
+    Reserve host resources for a guest 'name' with 'ram' (in MBs) and 'vcpus',
+    waiting (up to 'timeout' seconds) for other guests on the host to finish
+    if there isn't enough host RAM, CPUs or disk space.
+
+    Calling this again for the same guest just updates its resources.
+    """
+    end_time = time.monotonic() + timeout
+    waiting = False
+    while not try_acquire_guest_slot(name, ram, vcpus):
+        if not waiting:
+            util.log(f"waiting for host resources to run {name} ({ram} MB, {vcpus} vCPUs)")
+            waiting = True
+        if time.monotonic() > end_time:
+            raise TimeoutError(f"host resources for {name} not available for {timeout}sec")
+        time.sleep(5)
+
+
+def release_guest_slot(name):
+    """Release host resources reserved by acquire_guest_slot()."""
+    with _slots_ledger() as slots:
+        slots.pop(name, None)
+
+
+#
+# guest lifecycle phase timings, written as JSON lines to a test log,
+# with a per-phase summary logged at exit
+#
+
+TIMINGS_LOG = 'guest-timings.jsonl'
+
+_timings_lock = threading.Lock()
+_timings_path = None
+# phase -> list of durations, for the summary
+_timings = collections.defaultdict(list)
+
+
+def _log_timings_summary():
+    util.log("guest phase timings (count, total, mean, max):")
+    for phase, durations in _timings.items():
+        total = sum(durations)
+        util.log(
+            f"    {phase}: {len(durations)}x, {total:.1f}s, "
+            f"{total/len(durations):.2f}s, {max(durations):.2f}s",
+        )
+
+
+def _record_timing(record):
+    global _timings_path
+    line = json.dumps(record) + '\n'
+    with _timings_lock:
+        if _timings_path is None:
+            _timings_path = Path(results.register_log(TIMINGS_LOG)).absolute()
+            atexit.register(_log_timings_summary)
+        with open(_timings_path, 'a') as f:
+            f.write(line)
+        results.atex_upload_log_data(TIMINGS_LOG, line)
+        _timings[record['phase']].append(record['duration'])
+
+
+@contextlib.contextmanager
+def timed(phase, guest_name=None, **details):
+    """
+    Measure the wall time of a guest lifecycle 'phase' done inside the context
+    manager and record it, together with any extra JSON-compatible 'details'.
+    """
+    start_wall = time.time()
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        _record_timing({
+            'phase': phase,
+            'guest': guest_name,
+            'start': round(start_wall, 3),
+            'duration': round(time.monotonic() - start, 3),
+            **details,
+        })
+
+
 #
 # misc helpers
 #
 
+_background_pool = None
+
+
+def in_background(func, *args, **kwargs):
+    """
+    Run func(*args, **kwargs) in a shared background thread pool, returning
+    a concurrent.futures.Future.
+
+    During interpreter shutdown (ie. from atexit), when no new threads can be
+    started, run it right away instead.
+    """
+    global _background_pool
+    if _background_pool is None:
+        _background_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    try:
+        return _background_pool.submit(func, *args, **kwargs)
+    except RuntimeError:
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
 def virsh(*virsh_args, **run_args):
     # --quiet just skips the buggy trailing newline
     cmd = ['virsh', '--quiet', *virsh_args]
@@ -1005,6 +2615,14 @@ def calculate_guest_tag(tags):
 # libvirt domain (guest) XML operations
 #
 
+def _copy_image(source, dest):
+    """Copy a disk image, using a reflink if possible, preserving sparseness."""
+    util.subprocess_run(
+        ['cp', '--reflink=auto', '--sparse=always', source, dest],
+        check=True, stderr=subprocess.PIPE,
+    )
+
+
 def domain_xml_diskinfo(xmlstr):
     domain = ET.fromstring(xmlstr)
     devices = domain.find('devices')
@@ -1016,18 +2634,21 @@ def domain_xml_diskinfo(xmlstr):
     return (domain, devices, disk, driver, source)
 
 
-def get_image_disk_from_state_file(state_file):
-    """Get path/format of the first <disk> definition in a RAM image state file."""
-    ret = virsh('save-image-dumpxml', state_file, stdout=PIPE, check=True, text=True)
-    _, _, _, driver, source = domain_xml_diskinfo(ret.stdout)
+def get_image_disk_from_xml(xmlstr):
+    """Get path/format of the first <disk> definition in a domain XML."""
+    _, _, _, driver, source = domain_xml_diskinfo(xmlstr)
     image_format = driver.get('type')
     source_file = Path(source.get('file'))
     return (source_file, image_format)
 
 
+def get_image_disk_from_state_file(state_file):
+    """Get path/format of the first <disk> definition in a RAM image state file."""
+    return get_image_disk_from_xml(save_image_xml(state_file))
+
+
 def get_domain_base_image_disk(domain):
-    ret = virsh('dumpxml', domain, '--inactive', stdout=PIPE, check=True, text=True)
-    _, _, disk, driver, _ = domain_xml_diskinfo(ret.stdout)
+    _, _, disk, driver, _ = domain_xml_diskinfo(domain_xml(domain, inactive=True))
     backing_store = disk.find('backingStore')
     if backing_store:
         base_image = backing_store.find('source').get('file')
@@ -1038,10 +2659,9 @@ def get_domain_base_image_disk(domain):
     return (Path(base_image), base_image_format)
 
 
-def set_image_disk_in_state_file(state_file, source_file, image_format):
-    """Set a disk path/format inside a saved guest RAM image state file to 'source_file'."""
-    ret = virsh('save-image-dumpxml', state_file, stdout=PIPE, check=True, text=True)
-    domain, _, disk, driver, source = domain_xml_diskinfo(ret.stdout)
+def set_image_disk_in_xml(xmlstr, source_file, image_format):
+    """Return a domain XML (as bytes) with its first disk path/format changed."""
+    domain, _, disk, driver, source = domain_xml_diskinfo(xmlstr)
     driver.set('type', image_format)
     source.set('file', str(source_file))
     # saved state images have empty <backingStore/> for some weird reason,
@@ -1049,21 +2669,112 @@ def set_image_disk_in_state_file(state_file, source_file, image_format):
     backing_store = disk.find('backingStore')
     if backing_store is not None:
         disk.remove(backing_store)
-    with tempfile.NamedTemporaryFile(mode='wb', suffix='.xml') as f:
-        f.write(ET.tostring(domain))
-        f.flush()
-        virsh('save-image-define', state_file, f.name, check=True)
+    return ET.tostring(domain)
+
+
+def set_image_disk_in_state_file(state_file, source_file, image_format):
+    """Set a disk path/format inside a saved guest RAM image state file to 'source_file'."""
+    xml = set_image_disk_in_xml(save_image_xml(state_file), source_file, image_format)
+    save_image_define(state_file, xml)
+
+
+def clone_domain_xml(xmlstr, name, disk_path, mac, disk_format='qcow2'):
+    """
+    Return a copy of a domain XML (as bytes), renamed to 'name', using
+    'disk_path' (of 'disk_format') as its first disk and 'mac' as the MAC
+    address of its first network interface, with a unique identity.
+    """
+    domain = ET.fromstring(xmlstr)
+    domain.find('name').text = name
+    # let libvirt generate a new UUID
+    uuid_elem = domain.find('uuid')
+    if uuid_elem is not None:
+        domain.remove(uuid_elem)
+    ifaces = domain.findall('devices/interface')
+    for iface in ifaces:
+        mac_elem = iface.find('mac')
+        if mac_elem is not None:
+            iface.remove(mac_elem)
+    if ifaces:
+        ET.SubElement(ifaces[0], 'mac', address=mac)
+    # let libvirt pick a new vsock CID
+    cid = domain.find('devices/vsock/cid')
+    if cid is not None and cid.get('auto') == 'yes':
+        cid.attrib.pop('address', None)
+    # UEFI variables are per-domain, give the clone a copy of the boot entries
+    nvram = domain.find('os/nvram')
+    if nvram is not None and nvram.text:
+        nvram_path = Path(nvram.text)
+        clone_nvram = Path(GUEST_NVRAM_DIR) / f'{name}_VARS{nvram_path.suffix}'
+        shutil.copy(nvram_path, clone_nvram)
+        nvram.text = str(clone_nvram)
+    disk = domain.find('devices/disk')
+    driver = disk.find('driver')
+    source = disk.find('source')
+    if driver is None or source is None:
+        raise RuntimeError("invalid disk specification")
+    driver.set('type', disk_format)
+    source.set('file', str(disk_path))
+    backing_store = disk.find('backingStore')
+    if backing_store is not None:
+        disk.remove(backing_store)
+    return ET.tostring(domain)
+
+
+def shared_dirs_tags(shared_dirs):
+    """
+    Return tuples of (virtiofs tag, guest path) for a shared_dirs dict
+    of guest paths to host directories.
+    """
+    return [(f'contest{i}', path) for i, path in enumerate(shared_dirs or ())]
+
+
+def shared_dirs_domain_xml(xmlstr, shared_dirs):
+    """
+    Return a copy of a domain XML (as bytes) with a dict of guest paths
+    to host directories 'shared_dirs' added as virtiofs devices.
+
+    The directories are read-only on the host side too (virtiofsd --readonly),
+    so that a guest cannot re-mount them read-write.
+    """
+    domain = ET.fromstring(xmlstr)
+    # virtiofsd needs access to guest RAM
+    backing = domain.find('memoryBacking')
+    if backing is None:
+        backing = ET.SubElement(domain, 'memoryBacking')
+    for name in ['source', 'access']:
+        elem = backing.find(name)
+        if elem is not None:
+            backing.remove(elem)
+    ET.SubElement(backing, 'source', type='memfd')
+    ET.SubElement(backing, 'access', mode='shared')
+    devices = domain.find('devices')
+    for tag, guest_path in shared_dirs_tags(shared_dirs):
+        host_dir = Path(shared_dirs[guest_path]).absolute()
+        fs = ET.SubElement(devices, 'filesystem', type='mount', accessmode='passthrough')
+        ET.SubElement(fs, 'driver', type='virtiofs')
+        ET.SubElement(fs, 'source', dir=str(host_dir))
+        ET.SubElement(fs, 'target', dir=tag)
+        ET.SubElement(fs, 'readonly')
+    return ET.tostring(domain)
+
+
+def allow_page_sharing_xml(xmlstr):
+    """Return a copy of a domain XML (as bytes), with KSM page merging allowed."""
+    domain = ET.fromstring(xmlstr)
+    backing = domain.find('memoryBacking')
+    if backing is not None:
+        nosharepages = backing.find('nosharepages')
+        if nosharepages is not None:
+            backing.remove(nosharepages)
+    return ET.tostring(domain)
 
 
 def set_domain_memory(domain, amount, unit='MiB'):
     """Set the amount of RAM allowed for a defined guest."""
-    ret = virsh('dumpxml', domain, stdout=PIPE, check=True, text=True)
-    domain = ET.fromstring(ret.stdout)
+    domain = ET.fromstring(domain_xml(domain))
     for name in ['memory', 'currentMemory']:
         mem = domain.find(name)
         mem.set('unit', unit)
         mem.text = str(amount)
-    with tempfile.NamedTemporaryFile(mode='wb', suffix='.xml') as f:
-        f.write(ET.tostring(domain))
-        f.flush()
-        virsh('define', f.name, check=True)
+    define_domain(ET.tostring(domain))